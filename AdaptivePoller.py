@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+# Decides when the main loop should next ask the Cinema Processor for the fader level.
+#
+# Right after the knob or keyboard is used the display is refreshed every Config.POLLING_DELAY
+# seconds. While nobody touches anything, the delay grows by Config.POLLING_BACKOFF after every
+# poll until it reaches Config.POLLING_MAX_DELAY. Failed polls (errors, timeouts, rejected requests)
+# raise the shortest delay allowed, so a struggling processor is asked less often until it recovers.
+# Polls the rate limiter skipped aren't failures, they are just tried again a little later.
+# On a slow network the shortest delay is also kept to a few round trips to the processor.
+
+import time
+
+import Config
+
+class AdaptivePoller():
+    # The shortest delay is at least this many round trip times
+    RTT_FACTOR = 4
+
+    def __init__(self, minDelay=Config.POLLING_DELAY, maxDelay=Config.POLLING_MAX_DELAY, backoff=Config.POLLING_BACKOFF):
+        self.minDelay = minDelay
+        self.maxDelay = maxDelay
+        self.backoff = backoff
+        self.floor = minDelay           # Shortest delay allowed right now, raised by failures
+        self.delay = minDelay           # Delay until the poll after the next one
+        self.nextPoll = 0               # time.monotonic() when the next poll is due
+        self.failures = 0               # Failed polls in a row
+
+    # True when it's time to poll again
+    def due(self):
+        return time.monotonic() >= self.nextPoll
+
+    # Call this when the knob or keyboard is used, so the display follows closely
+    def activity(self):
+        self.delay = self.floor
+        self.nextPoll = min(self.nextPoll, time.monotonic() + self.floor)
+
+    # Call this when a poll has finished, ok being False if it failed.
+    # rtt is the processor's smoothed round trip time in seconds, if known (CinemaProcessor.rtt.srtt).
+    def polled(self, ok=True, rtt=None):
+        minDelay = self.minDelay if rtt is None else min(self.maxDelay, max(self.minDelay, self.RTT_FACTOR * rtt))
+        if ok:
+            self.failures = 0
+            self.floor = max(minDelay, self.floor / self.backoff)
+        else:
+            self.failures += 1
+            self.floor = min(self.maxDelay, self.floor * 2)
+        self.nextPoll = time.monotonic() + max(self.delay, self.floor)
+        self.delay = min(self.maxDelay, max(self.delay, self.floor) * self.backoff)
+
+    # Call this instead of polled when a poll was skipped without asking the processor, e.g. by
+    # the rate limiter. It is tried again after the shortest delay and doesn't count as a failure.
+    def skipped(self):
+        self.nextPoll = time.monotonic() + self.floor
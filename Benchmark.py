@@ -0,0 +1,363 @@
+#!/usr/bin/env python3
+# End-to-end benchmark: knob/keyboard input -> Cinema Processor command -> display.
+#
+# A virtual encoder and virtual volume keys are driven from a fixed script against a
+# ProcessorSimulator, once for each driver and each main loop strategy:
+#   legacy  the original blocking loop: a read-modify-write round trip per change and a fader
+#           query every POLLING_DELAY, sent straight to the processor (no queue, rate limiter or cache)
+#   current VolumeControl's own main loop (VolumeControl.loopStep), with the volume keys going
+#           through VolumeControl.press_on
+# For each run it measures input-to-command latency percentiles, commands per second,
+# the share of fader queries that couldn't have returned anything new, display update lag
+# and CPU time per loop iteration, and writes everything as JSON so versions can be compared.
+#
+# The table goes to stderr, so stdout only has the JSON.
+#
+# With --startup it measures boot time instead: how long VolumeControl and everything main()
+# loads for the given display type and processor take to import, in a fresh interpreter.
+#
+# Run it with: python3 Benchmark.py --output bench.json
+#         or:  python3 Benchmark.py --startup --display-type 2 --cp-type CP750
+
+import argparse
+import asyncio
+import contextlib
+import enum
+import json
+import math
+import os
+import platform
+import subprocess
+import sys
+import threading
+import time
+
+import CP650Control
+import CP750Control
+import CP850Control
+import CP950Control
+import JSD60Control
+import JSD100Control
+import ProcessorSimulator
+import AdaptivePoller
+import RotaryEncoder
+import VolumeControl
+import Config
+
+# driver name -> (driver class, simulator dialect)
+DRIVERS = {
+    'CP650': (CP650Control.CP650Control, 'cp650'),
+    'CP750': (CP750Control.CP750Control, 'dolby'),
+    'CP850': (CP850Control.CP850Control, 'dolby'),
+    'CP950': (CP950Control.CP950Control, 'dolby'),
+    'JSD60': (JSD60Control.JSD60Control, 'jsd'),
+    'JSD100': (JSD100Control.JSD100Control, 'jsd'),
+}
+
+# Stands in for pynput's Key when driving VolumeControl.press_on, so pynput isn't needed
+VirtualKey = enum.Enum('VirtualKey', 'esc media_volume_up media_volume_down f1 enter up down backspace')
+
+# A RotaryEncoder on simulated pins, the script turns it instead of a hand
+class VirtualEncoder(RotaryEncoder.RotaryEncoder):
+    def __init__(self):
+        super().__init__(0, 1, RotaryEncoder.SimulatedBackend())
+
+    def add(self, ticks):
+        self.backend.turn(ticks)
+
+# Builds the input script: (seconds from start, 'knob' or 'key', steps).
+# Fast spins of the knob alternating direction, with single volume key presses in between.
+def makeScript(duration, spinTicks=30, tickRate=150.0, spinEvery=1.0, keyEvery=0.7):
+    script = []
+    start = 0.2
+    direction = 1
+    while start < duration - 0.5:
+        for tick in range(spinTicks):
+            script.append((start + tick/tickRate, 'knob', direction))
+        direction = -direction
+        start += spinEvery
+    keyTime = 0.55
+    while keyTime < duration - 0.5:
+        script.append((keyTime, 'key', 1 if int(keyTime/keyEvery) % 2 else -1))
+        keyTime += keyEvery
+    return sorted(script)
+
+# Plays the script from its own thread, like the GPIO callbacks and the keyboard listener would
+def playScript(script, t0, enc, keyHandler, inputs):
+    for offset, kind, steps in script:
+        delay = t0 + offset - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        inputs.append(time.perf_counter())
+        if kind == 'knob':
+            enc.add(steps)
+        else:
+            keyHandler(steps)
+
+# The original main loop: every change is a blocking read followed by a write, and the display
+# is refreshed by a blocking query every POLLING_DELAY. Like the original driver, every command
+# goes straight to the processor and waits for its reply, without the queue, rate limiter or cache.
+def legacySend(cp, command):
+    return cp.decodereply(cp.run(cp.asendbatch([command]))[0])
+
+def legacyAddfader(cp, value):
+    fader = legacySend(cp, cp.FADER_QUERY)
+    if fader.ok:
+        legacySend(cp, cp.CODEC.write('fader', max(0, min(cp.FADER_MAX, fader.value + value*cp.FADER_STEP))))
+        return True
+    return False
+
+def legacyLoop(cp, enc, display, running, iterations):
+    while running.is_set():
+        iterations[0] += 1
+        volumeChange = enc.drain(Config.SENSITIVITY)
+        if(volumeChange):
+            legacyAddfader(cp, volumeChange)
+        fader = legacySend(cp, cp.FADER_QUERY)
+        display(cp.formatfader(fader.value) if fader.ok else False)
+        time.sleep(Config.POLLING_DELAY)
+
+# VolumeControl's main loop itself, on a connected processor
+def currentLoop(cp, enc, display, running, iterations):
+    observer = cp.stateCache.subscribe(lambda state: state.ok and display(cp.formatfader(state.fader)))
+    while running.is_set():
+        iterations[0] += 1
+        VolumeControl.loopStep(enc)
+        time.sleep(Config.LOOP_DELAY)
+    cp.stateCache.unsubscribe(observer)
+
+def currentKey(cp, steps):
+    VolumeControl.press_on(VirtualKey.media_volume_up if steps > 0 else VirtualKey.media_volume_down)
+
+STRATEGIES = {
+    'legacy': (legacyLoop, legacyAddfader),
+    'current': (currentLoop, currentKey),
+}
+
+# Points VolumeControl's globals at cp, as if main() had just connected to it
+def useVolumeControl(cp):
+    VolumeControl.cp = cp
+    VolumeControl.Key = VirtualKey
+    VolumeControl.pState = VolumeControl.ProgramState.CONNECTED
+    VolumeControl.connectRequest = None
+    VolumeControl.pollRequest = None
+    VolumeControl.poller = AdaptivePoller.AdaptivePoller()
+
+# CPU seconds used so far by the calling thread and the Cinema Processor event loop thread
+def controlCpuTime():
+    total = time.thread_time()
+    for thread in threading.enumerate():
+        if thread.name == 'CinemaProcessorLoop' and hasattr(time, 'pthread_getcpuclockid'):
+            total += time.clock_gettime(time.pthread_getcpuclockid(thread.ident))
+    return total
+
+def percentiles(values):
+    if not values:
+        return None
+    values = sorted(values)
+    pick = lambda p: values[min(len(values) - 1, max(0, math.ceil(p/100*len(values)) - 1))]
+    return {'p50': pick(50), 'p90': pick(90), 'p99': pick(99), 'max': values[-1],
+            'mean': sum(values)/len(values), 'count': len(values)}
+
+def isFaderWrite(command):
+    return 'fader' in command and not command.endswith('?') and any(separator in command for separator in ' =\t')
+
+def isFaderQuery(command):
+    return 'fader' in command and not isFaderWrite(command)
+
+def analyse(inputs, commands, displays, duration, iterations, cpuTime):
+    writes = [t for t, command in commands if isFaderWrite(command)]
+    latencies = []
+    for t in inputs:
+        later = [w for w in writes if w >= t]
+        if later:
+            latencies.append((later[0] - t)*1000)
+
+    # A fader query is redundant if nothing has written the fader since the last one
+    queries = redundant = 0
+    written = True
+    for _, command in commands:
+        if isFaderWrite(command):
+            written = True
+        elif isFaderQuery(command):
+            queries += 1
+            if not written:
+                redundant += 1
+            written = False
+
+    # Display lag: time from an input to the first display change after it
+    changes = []
+    for index in range(1, len(displays)):
+        if displays[index][1] != displays[index - 1][1]:
+            changes.append(displays[index][0])
+    lags = []
+    for t in inputs:
+        later = [c for c in changes if c >= t]
+        if later:
+            lags.append((later[0] - t)*1000)
+
+    return {
+        'inputs': len(inputs),
+        'commands': len(commands),
+        'commandsPerSecond': len(commands)/duration,
+        'faderWrites': len(writes),
+        'faderQueries': queries,
+        'redundantQueryRatio': redundant/queries if queries else 0.0,
+        'inputToCommandMs': percentiles(latencies),
+        'displayLagMs': percentiles(lags),
+        'loopIterations': iterations,
+        'cpuMsPerIteration': cpuTime/iterations*1000 if iterations else None,
+    }
+
+def runOne(driver, strategy, duration, simOptions, simLoop):
+    driverClass, dialect = DRIVERS[driver]
+    loopFunction, keyHandler = STRATEGIES[strategy]
+    sim = ProcessorSimulator.SimulatedProcessor(dialect, **simOptions)
+    asyncio.run_coroutine_threadsafe(sim.start(port=0), simLoop).result()
+    cp = driverClass('127.0.0.1', sim.port)
+    try:
+        if cp.connect() != 'connected':
+            raise RuntimeError(f'{driver} could not connect to the simulator')
+        useVolumeControl(cp)
+        enc = VirtualEncoder()
+        displays = []
+        display = lambda value: displays.append((time.perf_counter(), value))
+        running = threading.Event()
+        running.set()
+        iterations = [0]
+        inputs = []
+
+        sim.log.clear()
+        t0 = time.perf_counter()
+        player = threading.Thread(target=playScript, daemon=True,
+                                  args=(makeScript(duration), t0, enc, lambda steps: keyHandler(cp, steps), inputs))
+        player.start()
+        timer = threading.Timer(duration, running.clear)
+        timer.start()
+        cpuStart = controlCpuTime()
+        loopFunction(cp, enc, display, running, iterations)
+        cpuTime = controlCpuTime() - cpuStart
+        player.join()
+        elapsed = time.perf_counter() - t0
+        commands = [(t, command) for t, command in sim.log if t >= t0]
+        result = analyse(inputs, commands, displays, elapsed, iterations[0], cpuTime)
+    finally:
+        cp.disconnect()
+        asyncio.run_coroutine_threadsafe(sim.stop(), simLoop).result()
+    result.update({'driver': driver, 'strategy': strategy, 'duration': elapsed})
+    return result
+
+# Imported in a fresh interpreter by startupRun: VolumeControl, then what main() would load.
+# Libraries that aren't there (the Pi's display libraries on a PC) or fail without the hardware are reported.
+STARTUP_SCRIPT = '''
+import importlib
+import VolumeControl
+for name in VolumeControl.startupModules({displayType}, VolumeControl.CPTypeCode.{cpType}):
+    try:
+        importlib.import_module(name)
+    except Exception as ex:
+        print('MISSING', name, type(ex).__name__)
+'''
+
+# Runs code in a new interpreter with -X importtime. Returns the wall time in seconds, the
+# imports as (depth, module, self us, cumulative us) in the order they finished, and stdout.
+def startupRun(code):
+    start = time.perf_counter()
+    process = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], capture_output=True, text=True,
+                             cwd=os.path.dirname(os.path.abspath(__file__)))
+    elapsed = time.perf_counter() - start
+    imports = []
+    for line in process.stderr.splitlines():
+        if not line.startswith('import time:') or 'imported package' in line:
+            continue
+        selfTime, cumulative, name = line[len('import time:'):].split('|')
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        imports.append((depth, name.strip(), int(selfTime), int(cumulative)))
+    return elapsed, imports, process.stdout
+
+# Times startup `repeat` times and keeps the fastest run. Modules a bare interpreter imports as
+# well don't count towards the program's import time.
+def startupBenchmark(displayType, cpType, repeat, top):
+    bare = min((startupRun('pass') for _ in range(repeat)), key=lambda run: run[0])
+    baseline = {name for depth, name, _, _ in bare[1] if depth == 0}
+    code = STARTUP_SCRIPT.format(displayType=displayType, cpType=cpType)
+    elapsed, imports, output = min((startupRun(code) for _ in range(repeat)), key=lambda run: run[0])
+    program = [entry for entry in imports if not (entry[0] == 0 and entry[1] in baseline)]
+    total = sum(cumulative for depth, _, _, cumulative in program if depth == 0)
+    missing = [line.split()[1] for line in output.splitlines() if line.startswith('MISSING')]
+
+    print(f'startup ({cpType}, display type {displayType}): imports {total/1000:.1f}ms, '
+          f'wall {elapsed*1000:.1f}ms (bare interpreter {bare[0]*1000:.1f}ms)', file=sys.stderr)
+    for depth, name, selfTime, cumulative in sorted(program, key=lambda entry: -entry[3])[:top]:
+        print(f'  {cumulative/1000:7.1f}ms {selfTime/1000:7.1f}ms self  {"  "*depth}{name}', file=sys.stderr)
+    if missing:
+        print(f'  not installed or no hardware: {", ".join(missing)}', file=sys.stderr)
+    return {
+        'cpType': cpType,
+        'displayType': displayType,
+        'importMs': total/1000,
+        'wallMs': elapsed*1000,
+        'bareInterpreterMs': bare[0]*1000,
+        'missing': missing,
+        'imports': [{'module': name, 'depth': depth, 'selfMs': selfTime/1000, 'cumulativeMs': cumulative/1000}
+                    for depth, name, selfTime, cumulative in program],
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description='Knob-to-processor latency and throughput benchmark.')
+    parser.add_argument('--drivers', nargs='+', choices=list(DRIVERS), default=list(DRIVERS))
+    parser.add_argument('--strategies', nargs='+', choices=list(STRATEGIES), default=list(STRATEGIES))
+    parser.add_argument('--duration', type=float, default=3.0, help='seconds per run')
+    parser.add_argument('--latency', type=float, default=0.005, help='simulated processor latency in seconds')
+    parser.add_argument('--jitter', type=float, default=0.001)
+    parser.add_argument('--output', default=None, help='write the results to this JSON file')
+    parser.add_argument('--startup', action='store_true', help='measure import time at boot instead')
+    parser.add_argument('--display-type', type=int, default=Config.DISPLAYTYPE, help='DISPLAYTYPE for --startup')
+    parser.add_argument('--cp-type', choices=list(DRIVERS), default='CP750', help='processor for --startup')
+    parser.add_argument('--repeat', type=int, default=5, help='--startup runs, the fastest counts')
+    parser.add_argument('--top', type=int, default=15, help='slowest imports to list for --startup')
+    args = parser.parse_args()
+
+    if args.startup:
+        results = startupBenchmark(args.display_type, args.cp_type, args.repeat, args.top)
+    else:
+        results = latencyBenchmark(args)
+
+    report = {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'settings': vars(args),
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+def latencyBenchmark(args):
+
+    # The simulator gets its own thread and event loop, so it doesn't share CPU time with the control path
+    simLoop = asyncio.new_event_loop()
+    threading.Thread(target=simLoop.run_forever, name='SimulatorLoop', daemon=True).start()
+    simOptions = {'latency': args.latency, 'jitter': args.jitter, 'seed': 1}
+
+    results = []
+    for driver in args.drivers:
+        for strategy in args.strategies:
+            with contextlib.redirect_stdout(sys.stderr):     # Anything VolumeControl prints stays out of the JSON
+                result = runOne(driver, strategy, args.duration, simOptions, simLoop)
+            results.append(result)
+            latency = result['inputToCommandMs'] or {}
+            lag = result['displayLagMs'] or {}
+            print(f"{driver:7}{strategy:9}"
+                  f" cmd p50 {latency.get('p50', float('nan')):7.1f}ms p99 {latency.get('p99', float('nan')):7.1f}ms"
+                  f" | {result['commandsPerSecond']:6.1f} cmd/s"
+                  f" | redundant {result['redundantQueryRatio']:5.1%}"
+                  f" | display p50 {lag.get('p50', float('nan')):7.1f}ms"
+                  f" | cpu {result['cpuMsPerIteration'] or 0:.3f}ms/iter", file=sys.stderr)
+    return results
+
+if __name__ == '__main__':
+    main()
@@ -3,150 +3,28 @@
 
 #Modified from https://github.com/Cybso/cp750client
 
-import socket
 import logging
 import CinemaProcessor
+import ProtocolCodec
 import time
 
 # Only used for main() at time of writing this comment
 import Config
 
 LOGGER = logging.getLogger(__name__)
-ERROR_PREFIX='⚠'
-SOCKET_TIMEOUT=250
 
 # Dolby defined port.
 PORT = 61408
 
 
-def nonblocking_readline(f, timeout=SOCKET_TIMEOUT):
-    """ Waits up to 'timeout' milliseconds for data from f. Otherwise this returns None """
-    timeout = timeout + int(round(time.time() * 1000))
-    line = b""
-    while int(round(time.time() * 1000)) < timeout:
-        char = f.read(1)
-        if char is None:
-            time.sleep(0.01)
-            continue
-        line += char
-        if char == b"\n":
-            return line
-    raise IOError(0, 'Timeout')
-
-def error_to_str(e):
-    """ Converts an Exception to string """
-    if hasattr(e, 'message') and e.message is not None:
-        return ERROR_PREFIX + e.message
-    if hasattr(e, 'strerror') and e.strerror is not None:
-        return ERROR_PREFIX + e.strerror
-    return ERROR_PREFIX + type(e).__name__
-
 class CP750Control(CinemaProcessor.CinemaProcessor):
-    def __init__(self, host):
-        super().__init__(host, PORT)
-        self.stream = None
-    
-    def getState(self):
-        if self.socket is None:
-            return "disconnected"
-        else:
-            # Test if socket is alive...
-            LOGGER.debug('Testing if socket is alive')
-            result = self.send('cp750.sys.fader ?')
+    # Commands, replies and fader range (see ProtocolCodec)
+    CODEC = ProtocolCodec.CODECS['CP750']
+    # Commands per second and burst size (see CinemaProcessor.RATE_LIMIT)
+    RATE_LIMIT = (10, 5)
 
-            if not result or result.startswith(ERROR_PREFIX):
-                self.disconnect()
-                return result
-            return "connected"
-    
-    def connect(self):
-        if self.socket is not None:
-            self.disconnect()
-        LOGGER.debug("Connecting to %s:%d" % (self.destination, self.port))
-        try:
-            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            s.connect((self.destination, self.port))
-            s.settimeout(500)
-            s.setblocking(False)
-            self.stream = s.makefile("rwb", 0)
-            self.socket = s
-        except Exception as e:
-            LOGGER.exception("Failed to connect to %s:%d" % (self.destination, self.port))
-            return error_to_str(e)
-        return self.getState()
-    
-    def disconnect(self):
-        if self.socket is not None:
-            LOGGER.debug("Disconnecting from %s:%d" % (self.destination, self.port))
-            try:
-                self.socket.close()
-            except  Exception as e:
-                # LOGGER.exception("Failed to close connection")
-                return error_to_str(e)
-            finally:
-                self.socket = None
-                self.stream = None
-        return self.getState()
-    
-    def send(self, command):
-        LOGGER.debug("Command: %s" % command)
-        if self.socket is None:
-            self.connect()
-            if self.socket is None:
-                LOGGER.warning("Socket is disconnected")
-                return self.getState()
-        try:
-            result=""
-            self.stream.write(command.encode('UTF-8') + b"\r\n")
-            line=nonblocking_readline(self.stream).decode('UTF-8').strip()
-            while line:
-                result=result + line + "\n"
-                line=nonblocking_readline(self.stream).decode('UTF-8').strip()
-            result = result.strip()
-            LOGGER.debug(f'Response: {result}')
-            return result
-        except Exception as e:
-            LOGGER.exception("Command '%s' failed" % command)
-            return error_to_str(e)
-    
-    # Extracts the actual value from the response from the CP750
-#     def stripvalue(self, responseText):
-#         see CinemaProcessor
-    
-    # Adds or subtracts an integer to the fader
-    # ~ def addfader(self, value=1):
-        # ~ if(isinstance(value, int)):
-            # ~ if(value>=0):
-                # ~ self.send(f'cp750.ctrl.fader_delta +{value}')
-            # ~ else:
-                # ~ self.send(f'cp750.ctrl.fader_delta {value}')
-     
-    def getfader(self):
-        returnFader = self.send('cp750.sys.fader ?')
-        # ~ print(returnFader)
-        return self.stripvalue(returnFader)
-    
-    def setfader(self, value):
-        return self.stripvalue(self.send(f'cp750.sys.fader {value}'))
-    
-    def setmute(self, mute=1):
-        return self.stripvalue(self.send(f'cp750.sys.mute {mute}'))
-    
-    def getmute(self):
-        return self.stripvalue(self.send('cp750.sys.mute ?'))
-    
-    def getversion(self):
-        return self.stripvalue(self.send('cp750.sysinfo.version ?'))
-    
-    
-    def displayfader(self):
-        fader = self.getfader()
-        if(isinstance(fader, int)):
-            rawfader = str(fader)
-            formattedfader = rawfader[:-1]+'.'+rawfader[-1:] #add decimal point one space over from the right
-            return f'{str(formattedfader).rjust(5," ")}'
-        else:
-            return False
+    def __init__(self, host, port=PORT):
+        super().__init__(host, port)
     
 def main():
     logging.basicConfig(filename='CP750Control.log', encoding='utf-16', level=logging.INFO)
@@ -0,0 +1,19 @@
+#!/usr/bin/env python3
+#This class deals with communicating with the CP950
+
+import CP850Control
+import ProtocolCodec
+import logging
+
+LOGGER = logging.getLogger(__name__)
+
+# Dolby defined port.
+PORT = 61408
+
+
+class CP950Control(CP850Control.CP850Control):
+    # Same commands as the CP850 (see ProtocolCodec)
+    CODEC = ProtocolCodec.CODECS['CP950']
+
+    def __init__(self, host, port=PORT):
+        super().__init__(host, port)
@@ -1,72 +1,843 @@
 #!/usr/bin/env python3
 # This is an abstract class for Cinema Processors to in
 
+import asyncio
+import collections
+import itertools
+import logging
+import random
 import socket
-from abc import ABC, abstractmethod 
+import threading
+import time
+from abc import ABC
+
+import FaderScheduler
+import FaderRamp
+import Metrics
+import ProcessorState
+import ProtocolCodec
+import RateLimiter
+import Config
+
+LOGGER = logging.getLogger(__name__)
+ERROR_PREFIX='⚠'
+
+# Priorities in the command queue, most urgent first: the user's fader changes, then mute
+# changes, then reads somebody asked for, then the background polls that keep the display up to
+# date. Only background polls are dropped when the rate limit is reached, everything else waits.
+PRIORITY_WRITE = 0
+PRIORITY_MUTE = 1
+PRIORITY_POLL = 2
+PRIORITY_BACKGROUND = 3
+
+# The reply to a background poll the rate limiter didn't let through
+RATE_LIMITED = ERROR_PREFIX + 'RateLimited'
+# The reply to a command that got no reply in time, was skipped by the processor while
+# pipelining, couldn't be sent because there was no connection, or was dropped from the queue
+TIMEOUT = ERROR_PREFIX + 'Timeout'
+NO_RESPONSE = ERROR_PREFIX + 'No response'
+DISCONNECTED = ERROR_PREFIX + 'Disconnected'
+CANCELLED = ERROR_PREFIX + 'Cancelled'
+
+# The ProcessorState.ErrorCode for each of the error replies above. Any other error string is
+# a network or socket error (see error_to_str).
+ERROR_CODES = {
+    TIMEOUT: ProcessorState.ErrorCode.TIMEOUT,
+    NO_RESPONSE: ProcessorState.ErrorCode.NO_RESPONSE,
+    DISCONNECTED: ProcessorState.ErrorCode.DISCONNECTED,
+    RATE_LIMITED: ProcessorState.ErrorCode.RATE_LIMITED,
+    CANCELLED: ProcessorState.ErrorCode.CANCELLED,
+}
+
+def error_to_str(e):
+    """ Converts an Exception to string """
+    if hasattr(e, 'message') and e.message is not None:
+        return ERROR_PREFIX + e.message
+    if hasattr(e, 'strerror') and e.strerror is not None:
+        return ERROR_PREFIX + e.strerror
+    return ERROR_PREFIX + type(e).__name__
+
+# All Cinema Processor network I/O runs on one asyncio event loop in a background thread,
+# so a slow reply from the processor never holds up the encoder, the keyboard or the displays.
+_eventLoop = None
+_eventLoopLock = threading.Lock()
+
+def getEventLoop():
+    """ Returns the shared event loop, starting its thread the first time it is needed """
+    global _eventLoop
+    with _eventLoopLock:
+        if _eventLoop is None:
+            _eventLoop = asyncio.new_event_loop()
+            threading.Thread(target=_eventLoop.run_forever, name='CinemaProcessorLoop', daemon=True).start()
+    return _eventLoop
+
+# A buffered connection to a Cinema Processor that splits what it receives into lines.
+# Every processor we support answers with one line per command, terminated by CRLF.
+# Incoming data is read straight into one reusable bytearray by the event loop, so partial
+# lines that arrive over several TCP segments and several replies that arrive in one segment
+# are both handled, and nothing has to poll or sleep while waiting for a reply.
+#
+# It also keeps track of whether the connection is still alive, from what the socket reports:
+# TCP keepalive probes notice a processor that vanished without closing the connection, and
+# end of file or an error marks the connection closed. No commands are sent just to check.
+class LineTransport(asyncio.BufferedProtocol):
+    BUFFER_SIZE = 4096          # Starting size of the receive buffer
+    MAX_BUFFER_SIZE = 65536     # A "line" longer than this is garbage and gets thrown away
+    KEEPALIVE_IDLE = 5          # Seconds of silence before the first keepalive probe
+    KEEPALIVE_INTERVAL = 2      # Seconds between probes
+    KEEPALIVE_COUNT = 3         # Unanswered probes before the connection counts as dead
+
+    def __init__(self, metrics=None):
+        self.transport = None
+        self.metrics = metrics  # Metrics.ProcessorMetrics that counts the bytes, if any
+        self.buffer = bytearray(self.BUFFER_SIZE)
+        self.used = 0           # Bytes of self.buffer holding data that isn't a complete line yet
+        self.discarding = False # True while throwing away the rest of a line that was too long
+        self.lines = collections.deque()
+        self.waiter = None      # Future resolved when a line arrives or the connection closes
+        self.closed = False
+        self.error = None
+        self.lastReply = None   # time.monotonic() when the last line arrived
+
+    # asyncio.BufferedProtocol callbacks, called on the event loop
+
+    def connection_made(self, transport):
+        self.transport = transport
+        sock = transport.get_extra_info('socket')
+        if sock is not None:
+            try:
+                # Commands are tiny and latency matters, don't let Nagle hold them back
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+                # Not every platform lets the keepalive timing be set
+                for option, value in (('TCP_KEEPIDLE', self.KEEPALIVE_IDLE), ('TCP_KEEPINTVL', self.KEEPALIVE_INTERVAL),
+                                      ('TCP_KEEPCNT', self.KEEPALIVE_COUNT)):
+                    if hasattr(socket, option):
+                        sock.setsockopt(socket.IPPROTO_TCP, getattr(socket, option), value)
+            except OSError as e:
+                LOGGER.warning(f'Could not set socket options: {e}')
+
+    def get_buffer(self, sizehint):
+        if self.used == len(self.buffer):
+            if len(self.buffer) >= self.MAX_BUFFER_SIZE:
+                LOGGER.warning(f'Discarding a line longer than {self.used} bytes')
+                self.used = 0
+                self.discarding = True
+            else:
+                self.buffer.extend(bytes(len(self.buffer)))
+        return memoryview(self.buffer)[self.used:]
+
+    def buffer_updated(self, nbytes):
+        if self.metrics is not None:
+            self.metrics.bytesIn += nbytes
+        scanFrom = self.used
+        self.used += nbytes
+        if self.discarding:
+            # The rest of an overlong line goes too, up to and including its line ending
+            end = self.buffer.find(b'\n', scanFrom, self.used)
+            if end < 0:
+                self.used = scanFrom
+                return
+            rest = self.used - end - 1
+            self.buffer[scanFrom:scanFrom + rest] = self.buffer[end + 1:self.used]
+            self.used = scanFrom + rest
+            self.discarding = False
+        start = 0
+        end = self.buffer.find(b'\n', scanFrom, self.used)
+        while end >= 0:
+            line = bytes(self.buffer[start:end]).strip()
+            if line:
+                self.lines.append(line)
+                self.lastReply = time.monotonic()
+            start = end + 1
+            end = self.buffer.find(b'\n', start, self.used)
+        if start:
+            # Move the incomplete rest of the data to the front of the buffer
+            self.buffer[:self.used - start] = self.buffer[start:self.used]
+            self.used -= start
+            self.wake()
+
+    def eof_received(self):
+        self.closed = True
+        self.wake()
+        return False
+
+    def connection_lost(self, exc):
+        self.closed = True
+        self.error = exc
+        self.wake()
+
+    def wake(self):
+        if self.waiter is not None and not self.waiter.done():
+            self.waiter.set_result(None)
+
+    # Used by CinemaProcessor
+
+    def write(self, data):
+        if self.closed:
+            raise ConnectionResetError(0, 'Connection closed')
+        if self.metrics is not None:
+            self.metrics.bytesOut += len(data)
+        self.transport.write(data)
+
+    # Throws away complete lines nobody asked for (for example a late reply to a command that timed out)
+    def discard(self):
+        while self.lines:
+            LOGGER.debug(f'Discarding unexpected response: {self.lines.popleft()}')
+
+    # Waits up to timeout seconds for the next complete line and returns it without the line ending
+    async def readline(self, timeout):
+        deadline = time.monotonic() + timeout
+        while not self.lines:
+            if self.closed:
+                if self.error is not None:
+                    raise self.error
+                raise ConnectionResetError(0, 'Connection closed')
+            self.waiter = asyncio.get_running_loop().create_future()
+            try:
+                await asyncio.wait_for(self.waiter, deadline - time.monotonic())
+            finally:
+                self.waiter = None
+        return self.lines.popleft()
+
+    def close(self):
+        self.closed = True
+        if self.transport is not None:
+            self.transport.close()
+
+# Estimates the round trip time to the processor and how long to wait for a reply, the way TCP
+# does (RFC 6298): a smoothed RTT and its variance are updated from every reply, and the timeout
+# is the smoothed RTT plus four times the variance. After a timeout the timeout is doubled, and
+# the next reply isn't measured because it might be the late reply to the command that timed
+# out (Karn's rule).
+class RttEstimator():
+    def __init__(self, initial, minimum=Config.MIN_REPLY_TIMEOUT, maximum=Config.MAX_REPLY_TIMEOUT, metrics=None):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.srtt = None                # Smoothed round trip time in seconds, None until the first reply
+        self.rttvar = None              # Its mean deviation
+        self.rto = initial              # Seconds to wait for the next reply
+        self.ambiguous = False          # True if the next reply can't be trusted for timing
+        self.metrics = metrics          # Metrics.ProcessorMetrics that shows srtt and rto, if any
+        self.publish()
+
+    # Call with the round trip time of every reply
+    def sample(self, seconds):
+        if self.ambiguous:
+            self.ambiguous = False
+            return
+        if self.srtt is None:
+            self.srtt = seconds
+            self.rttvar = seconds / 2
+        else:
+            self.rttvar = 0.75*self.rttvar + 0.25*abs(self.srtt - seconds)
+            self.srtt = 0.875*self.srtt + 0.125*seconds
+        self.rto = max(self.minimum, min(self.maximum, self.srtt + 4*self.rttvar))
+        self.publish()
+
+    # Call when a command timed out
+    def timedout(self):
+        self.rto = min(self.maximum, self.rto * 2)
+        self.ambiguous = True
+        self.publish()
+
+    def publish(self):
+        if self.metrics is not None:
+            self.metrics.srtt = self.srtt
+            self.metrics.rto = self.rto
+
+# Remembers the last known fader and mute levels and when they were learnt, so reads can be
+# answered locally instead of asking the Cinema Processor again.
+# Values are only cached if they are integers, error strings are never cached.
+#
+# It also keeps the whole state as a ProcessorState snapshot in state, together with the error
+# from the last failed poll. Whenever that changes a new snapshot is made and handed to every
+# observer (see subscribe), so the display only needs to be redrawn when there is something new.
+class StateCache():
+    def __init__(self, ttl=Config.STATE_CACHE_TTL):
+        self.ttl = ttl                  # Seconds a value stays valid
+        self.values = {}                # name -> (value, time.monotonic() when it was stored)
+        self.state = ProcessorState.ProcessorState()
+        self.observers = []
+
+    def put(self, name, value):
+        if isinstance(value, int):
+            changed = self.values.get(name, (None,))[0] != value
+            self.values[name] = (value, time.monotonic())
+            if changed or self.state.error:
+                self.publish(ProcessorState.ErrorCode.NONE)
+        return value
+
+    # Records the error (a ProcessorState.ErrorCode) from the last read of the state, NONE once reads work again
+    def seterror(self, error):
+        if self.state.error != error:
+            self.publish(error)
+
+    # Calls callback(state) with the new ProcessorState after every change, on the event loop
+    # thread, so it must not block. Returns callback, for unsubscribe.
+    def subscribe(self, callback):
+        self.observers.append(callback)
+        return callback
+
+    def unsubscribe(self, callback):
+        if callback in self.observers:
+            self.observers.remove(callback)
+
+    # Makes a new snapshot from the cached values and hands it to the observers
+    def publish(self, error):
+        self.state = ProcessorState.ProcessorState(self.values.get('fader', (None,))[0], self.values.get('mute', (None,))[0],
+                                                   time.monotonic(), error)
+        for observer in list(self.observers):
+            try:
+                observer(self.state)
+            except Exception:
+                LOGGER.exception("State observer failed")
+
+    # Returns the cached value, or None if there isn't one younger than maxAge (defaults to the TTL)
+    def get(self, name, maxAge=None):
+        if maxAge is None:
+            maxAge = self.ttl
+        cached = self.values.get(name)
+        if cached is None or time.monotonic() - cached[1] > maxAge:
+            return None
+        return cached[0]
+
+    def invalidate(self, name=None):
+        if name is None:
+            self.values.clear()
+        else:
+            self.values.pop(name, None)
+        self.publish(self.state.error)
+
+# Returns the bytes to send for a command, which may already be encoded (see ProtocolCodec.Command)
+def encode(command):
+    data = getattr(command, 'data', None)
+    return data if data is not None else command.encode('UTF-8') + ProtocolCodec.LINE_END
+
+# A command waiting in a Cinema Processor's queue, and the future its reply goes to
+class QueuedCommand():
+    def __init__(self, priority, order, command, future):
+        self.priority = priority
+        self.order = order
+        self.command = command
+        self.future = future
+
+    # Sort key for the queue: by priority, then first come first served
+    def key(self):
+        return self.priority, self.order
+
+    # Hands over the reply, which can also be a done future whose result is the reply
+    def answer(self, result):
+        if isinstance(result, asyncio.Future):
+            result = CANCELLED if result.cancelled() else result.result()
+        if not self.future.done():
+            self.future.set_result(result)
+
+# The async variant of a Cinema Processor. Every method that touches the network is a coroutine
+# and must be run on the shared event loop (see getEventLoop()).
+class AsyncCinemaProcessor(ABC):
+    # How much one step of the knob (0.1 on the display) moves the fader, and the highest fader value.
+    # Override these when the processor counts the fader differently.
+    FADER_STEP = 1
+    FADER_MAX = 100
+
+    # Seconds to wait for the first reply. After that the wait is worked out from how fast the
+    # processor actually answers (see RttEstimator).
+    REPLY_TIMEOUT = 1
+
+    # A connection that times out after this many seconds without any reply is closed, so the
+    # next command reconnects. That catches a processor that stopped answering but kept the socket open.
+    DEAD_AFTER = 5
+
+    # Set to False for processors that can't take a new command before they have answered the last one.
+    # Processors whose replies don't name the parameter (see ProtocolCodec.Codec.echo) are never
+    # pipelined either: if a reply got lost, the next one would be taken for it.
+    PIPELINING = True
+
+    # Pipelined batches in a row the processor skips commands in before falling back to one command
+    # at a time, and commands in a row answered that way before pipelining is tried again
+    PIPELINE_MAX_FAILURES = 3
+    PIPELINE_RETRY_AFTER = 100
+
+    # Commands per second and burst size the processor takes (see RateLimiter and Config.RATE_LIMITS)
+    RATE_LIMIT = (20, 10)
+
+    # The ProtocolCodec.Codec for the processor's commands and replies. Every driver must set this,
+    # FADER_STEP, FADER_MAX and the queries below are then taken from it.
+    CODEC = None
+
+    # The commands that ask for the fader and mute levels
+    FADER_QUERY = None
+    MUTE_QUERY = None
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        if cls.__dict__.get('CODEC') is not None:
+            cls.FADER_QUERY = cls.CODEC.query('fader')
+            cls.MUTE_QUERY = cls.CODEC.query('mute')
+            cls.FADER_STEP = cls.CODEC.faderStep
+            cls.FADER_MAX = cls.CODEC.faderMax
 
-class CinemaProcessor(ABC):
     def __init__(self, host, port):
         self.destination = host
         self.port = port
-        self.socket = None
-    
-    @abstractmethod
+        self.transport = None
+        self.commandLock = None         # See lock
+        self.pipelineAllowed = self.PIPELINING and Config.PIPELINING and self.CODEC.echo
+        self.pipelining = self.pipelineAllowed
+        self.pipelineFailures = 0       # Pipelined batches in a row with skipped commands
+        self.answeredInARow = 0         # Commands answered in a row since pipelining was turned off
+        # Every command goes through this queue and is sent by a single worker task (see asendmany)
+        self.queue = []
+        self.queueOrder = itertools.count()
+        self.workerTask = None
+        self.stateCache = StateCache()
+        self.faderScheduler = FaderScheduler.FaderScheduler(self)
+        self.faderRamp = FaderRamp.FaderRamp(self)
+        self.metrics = Metrics.processor(f'{type(self).__name__}@{host}:{port}')
+        self.rtt = RttEstimator(self.REPLY_TIMEOUT, metrics=self.metrics)
+        rate, burst = self.ratelimit()
+        self.rateLimiter = RateLimiter.TokenBucket(rate, burst, self.metrics)
+
+    # Returns (rate, burst) for this processor: Config.RATE_LIMITS for its model if set there, else
+    # for the model the driver is based on (a CP950 uses the CP850's), else the driver's RATE_LIMIT
+    def ratelimit(self):
+        for cls in type(self).__mro__:
+            codec = cls.__dict__.get('CODEC')
+            if codec is not None and codec.name in Config.RATE_LIMITS:
+                return Config.RATE_LIMITS[codec.name]
+        return self.RATE_LIMIT
+
+    # Returns "connected", "disconnected", or an error string if the connection has died since
+    # it was last used. Only looks at what the connection has reported, nothing is sent.
+    async def agetState(self):
+        if self.transport is None:
+            return "disconnected"
+        if self.transport.closed:
+            LOGGER.info(f'Connection to {self.destination}:{self.port} lost')
+            error = error_to_str(self.transport.error) if self.transport.error is not None else ERROR_PREFIX + 'Connection closed'
+            self.close()
+            return error
+        return "connected"
+
+    # Only one command may be on the wire at a time, otherwise replies get mixed up.
+    # The lock is made on the event loop the first time it is needed: before Python 3.10 an
+    # asyncio.Lock belongs to the loop that was current when it was made, and objects are
+    # usually made on the main thread.
+    @property
+    def lock(self):
+        if self.commandLock is None:
+            self.commandLock = asyncio.Lock()
+        return self.commandLock
+
+    # time.monotonic() of the last reply from the processor, None if there hasn't been one on this connection
+    @property
+    def lastReplyTime(self):
+        return self.transport.lastReply if self.transport is not None else None
+
+    async def aconnect(self):
+        async with self.lock:
+            self.close()
+            error = await self.aopen()
+        return error or await self.agetState()
+
+    async def adisconnect(self):
+        async with self.lock:
+            error = self.close()
+        return error or "disconnected"
+
+    # Keeps trying to connect until it works, waiting longer after each failure (see
+    # Config.RECONNECT_DELAY). Returns "connected". Cancel it to stop trying.
+    async def areconnect(self):
+        delay = Config.RECONNECT_DELAY
+        while True:
+            state = await self.aconnect()
+            if state == "connected":
+                return state
+            # Randomise the wait a bit so several remotes don't all knock at the same moment
+            wait = random.uniform(delay / 2, delay)
+            LOGGER.info(f'Connecting failed ({state}), trying again in {wait:.2f}s')
+            await asyncio.sleep(wait)
+            delay = min(Config.RECONNECT_MAX_DELAY, delay * 2)
+
+    # Opens the connection. Returns None, or an error string if that failed. Hold the lock.
+    async def aopen(self):
+        LOGGER.debug("Connecting to %s:%d" % (self.destination, self.port))
+        try:
+            loop = asyncio.get_running_loop()
+            _, self.transport = await asyncio.wait_for(
+                loop.create_connection(lambda: LineTransport(self.metrics), self.destination, self.port),
+                Config.CONNECT_TIMEOUT)
+        except Exception as e:
+            LOGGER.exception("Failed to connect to %s:%d" % (self.destination, self.port))
+            self.metrics.connectFailures += 1
+            return error_to_str(e)
+        self.metrics.connected()
+        return None
+
+    # Closes the connection. Returns None, or an error string if that failed. Hold the lock.
+    def close(self):
+        if self.transport is not None:
+            LOGGER.debug("Disconnecting from %s:%d" % (self.destination, self.port))
+            try:
+                self.transport.close()
+            except Exception as e:
+                LOGGER.exception("Failed to close connection")
+                return error_to_str(e)
+            finally:
+                self.transport = None
+                self.stateCache.invalidate()
+        return None
+
+    # Sends one command and returns the processor's one line reply, or an error string starting with ERROR_PREFIX.
+    # See asendmany for priority and supersedes.
+    async def asend(self, command, priority=PRIORITY_POLL, supersedes=None):
+        return (await self.asendmany([command], priority, supersedes))[0]
+
+    # Sends several commands and returns their replies in the same order.
+    # The commands are queued with the given priority (one of the PRIORITY_ constants) and sent by
+    # the queue's worker, which is the only thing that ever touches the connection, so callers on
+    # any thread can't interleave their commands or read each other's replies. If supersedes is a
+    # query command, copies of it still waiting in the queue are dropped and answered with the
+    # reply to these commands instead, e.g. a fader write answers the fader polls behind it.
+    async def asendmany(self, commands, priority=PRIORITY_POLL, supersedes=None):
+        loop = asyncio.get_running_loop()
+        entries = [QueuedCommand(priority, next(self.queueOrder), command, loop.create_future()) for command in commands]
+        if supersedes is not None:
+            for entry in [entry for entry in self.queue if entry.command == supersedes]:
+                self.queue.remove(entry)
+                entries[-1].future.add_done_callback(entry.answer)
+                self.metrics.superseded += 1
+        self.queue += entries
+        if self.workerTask is None:
+            self.workerTask = loop.create_task(self.aworker())
+        return list(await asyncio.gather(*(entry.future for entry in entries)))
+
+    # Sends whatever is in the queue, most urgent first, until it is empty, within the rate limit.
+    # When pipelining, everything queued goes out as one batch. Otherwise one command is taken at
+    # a time, so a write that arrives during a slow batch of polls goes next.
+    async def aworker(self):
+        try:
+            while self.queue:
+                self.queue.sort(key=QueuedCommand.key)
+                count = len(self.queue) if self.pipelining else 1
+                batch = [entry for entry in self.queue[:count] if not entry.future.done()]
+                del self.queue[:count]
+                # Writes and reads wait for their tokens, background polls only go if there is a token to spare
+                waiting = sum(1 for entry in batch if entry.priority != PRIORITY_BACKGROUND)
+                if waiting:
+                    await self.rateLimiter.acquire(waiting)
+                for entry in [entry for entry in batch if entry.priority == PRIORITY_BACKGROUND]:
+                    if not self.rateLimiter.tryacquire():
+                        entry.answer(RATE_LIMITED)
+                        batch.remove(entry)
+                if not batch:
+                    continue
+                try:
+                    results = await self.asendbatch([entry.command for entry in batch])
+                except Exception as e:
+                    LOGGER.exception("Command queue error")
+                    results = [error_to_str(e)] * len(batch)
+                for entry, result in zip(batch, results):
+                    entry.answer(result)
+        finally:
+            self.workerTask = None
+
+    # Sends a batch of commands for the worker and returns their replies.
+    # When pipelining, all commands go out in one write and the replies are matched back to them in
+    # FIFO order with matchresponse(). Otherwise each command waits for its reply before the next is sent.
+    async def asendbatch(self, commands):
+        LOGGER.debug("Commands: %s" % commands)
+        results = []
+        pipelined = self.pipelining and len(commands) > 1
+        try:
+            async with self.lock:
+                if self.transport is None:
+                    await self.aopen()
+                    if self.transport is None:
+                        LOGGER.warning("Socket is disconnected")
+                        return [DISCONNECTED] * len(commands)
+                self.transport.discard()
+                if pipelined:
+                    sentAt = time.perf_counter()
+                    self.transport.write(b"".join(encode(command) for command in commands))
+                    await self.areadreplies(commands, results, sentAt)
+                else:
+                    for command in commands:
+                        sentAt = time.perf_counter()
+                        self.transport.write(encode(command))
+                        results.append(await self.areadreply(command))
+                        self.metrics.observe(command, time.perf_counter() - sentAt)
+                        self.rtt.sample(time.perf_counter() - sentAt)
+            LOGGER.debug(f'Response: {results}')
+        except asyncio.TimeoutError:
+            LOGGER.warning("Command '%s' timed out" % commands[len(results)])
+            self.metrics.timeouts += 1
+            self.rtt.timedout()
+            lastReply = self.lastReplyTime
+            if self.transport is not None and (lastReply is None or time.monotonic() - lastReply > self.DEAD_AFTER):
+                LOGGER.warning(f'No reply from {self.destination}:{self.port} for too long, closing the connection')
+                self.close()
+            elif self.transport is not None and not self.CODEC.echo:
+                # The late reply could be taken for the answer to the next command, nothing tells them apart
+                LOGGER.warning(f'Closing the connection to {self.destination}:{self.port}, a late reply can\'t be matched')
+                self.close()
+            results += [TIMEOUT] * (len(commands) - len(results))
+        except Exception as e:
+            LOGGER.exception("Command '%s' failed" % commands[len(results)])
+            self.metrics.errors += 1
+            results += [error_to_str(e)] * (len(commands) - len(results))
+        self.pipelinehealth(pipelined, results)
+        return results
+
+    # Reads the reply to command, throwing away lines that can't be its reply (such as a late reply
+    # to a command that timed out). Times out if no matching line arrives within the reply timeout.
+    async def areadreply(self, command):
+        deadline = time.monotonic() + self.rtt.rto
+        while True:
+            reply = (await self.transport.readline(max(0, deadline - time.monotonic()))).decode('UTF-8')
+            if self.matchresponse(command, reply):
+                return reply
+            LOGGER.debug(f'Discarding unexpected response: {reply}')
+
+    # Reads the replies to pipelined commands (written at time.perf_counter() sentAt) into results.
+    # A reply is matched to the oldest command still waiting that it could belong to. Commands
+    # skipped over that way never got a reply, and lines that match nothing are thrown away.
+    async def areadreplies(self, commands, results, sentAt):
+        while len(results) < len(commands):
+            reply = (await self.transport.readline(self.rtt.rto)).decode('UTF-8')
+            for index in range(len(results), len(commands)):
+                if self.matchresponse(commands[index], reply):
+                    break
+            else:
+                LOGGER.debug(f'Discarding unexpected response: {reply}')
+                continue
+            if index > len(results):
+                LOGGER.warning("No response to '%s'" % commands[len(results):index])
+                self.metrics.errors += index - len(results)
+                results += [NO_RESPONSE] * (index - len(results))
+            self.metrics.observe(commands[index], time.perf_counter() - sentAt)
+            # Later replies in the batch also waited for the ones before them, only the first is a clean round trip
+            if index == 0:
+                self.rtt.sample(time.perf_counter() - sentAt)
+            results.append(reply)
+
+    # Keeps track of how well pipelining works for this processor from the results of each batch.
+    # After PIPELINE_MAX_FAILURES pipelined batches in a row where the processor skipped commands it
+    # falls back to one command at a time, and after PIPELINE_RETRY_AFTER commands in a row were
+    # answered that way pipelining is tried again. Timeouts don't count either way, they only show
+    # that the network was slow.
+    def pipelinehealth(self, pipelined, results):
+        if TIMEOUT in results:
+            return
+        if pipelined:
+            if NO_RESPONSE not in results:
+                self.pipelineFailures = 0
+                return
+            self.pipelineFailures += 1
+            if self.pipelineFailures >= self.PIPELINE_MAX_FAILURES:
+                LOGGER.warning(f'Pipelining disabled for {self.destination}:{self.port}')
+                self.pipelining = False
+                self.answeredInARow = 0
+        elif self.pipelineAllowed and not self.pipelining:
+            if any(result.startswith(ERROR_PREFIX) for result in results):
+                self.answeredInARow = 0
+                return
+            self.answeredInARow += len(results)
+            if self.answeredInARow >= self.PIPELINE_RETRY_AFTER:
+                LOGGER.info(f'Pipelining enabled again for {self.destination}:{self.port}')
+                self.pipelining = True
+                self.pipelineFailures = 0
+
+    # Returns True if response looks like the reply to command (see ProtocolCodec.Codec.matches)
+    def matchresponse(self, command, response):
+        return self.CODEC.matches(command, response)
+
+    # Returns the value in a reply, as an integer if it's a number. Error strings are returned unchanged.
+    def stripvalue(self, responseText):
+        return self.CODEC.parse(responseText, ERROR_PREFIX)
+
+    # Returns a reply (or error string) as a ProcessorState.Reply holding either the value or an error code
+    def decodereply(self, responseText):
+        if responseText.startswith(ERROR_PREFIX):
+            return ProcessorState.Reply(None, ERROR_CODES.get(responseText, ProcessorState.ErrorCode.CONNECTION), responseText)
+        return self.CODEC.decode(responseText)
+
+    # Adds value steps to the fader. The change is coalesced with other changes made in the
+    # next few milliseconds and written as one absolute level (see FaderScheduler).
+    # Returns True if the change was accepted.
+    async def aaddfader(self, value=1):
+        return self.faderScheduler.add(value)
+
+    # Fades the fader to target (in processor units) over duration seconds along one of the
+    # FaderRamp.CURVES. Returns True once there, False if the fade failed or was cancelled,
+    # which happens as soon as the knob or a volume key is used (see FaderScheduler.add).
+    async def afade(self, target, duration, curve='linear'):
+        task = self.faderRamp.start(target, duration, curve)
+        try:
+            return await task
+        except asyncio.CancelledError:
+            if task.cancelled():
+                return False
+            raise
+
+    def cancelfade(self):
+        self.faderRamp.cancel()
+
+    # Fader and mute reads and writes return a ProcessorState.Reply: the level in value if ok,
+    # otherwise the error code in error and the error string in text.
+    # Reads go to the state cache first and only ask the Cinema Processor once the cached value
+    # is older than maxAge (defaults to Config.STATE_CACHE_TTL). Pass maxAge=0 to force a query.
+    # Writes update the cache with the processor's reply straight away.
+    async def agetfader(self, maxAge=None):
+        cached = self.stateCache.get('fader', maxAge)
+        if cached is not None:
+            return ProcessorState.Reply(cached)
+        return (await self.apollstate(maxAge))[0]
+
+    async def asetfader(self, value):
+        reply = await self.asendfader(value)
+        if reply.ok:
+            self.stateCache.put('fader', reply.value)
+        return reply
+
+    async def asetmute(self, mute=1):
+        reply = await self.asendmute(mute)
+        if reply.ok:
+            self.stateCache.put('mute', reply.value)
+        return reply
+
+    async def agetmute(self, maxAge=None):
+        cached = self.stateCache.get('mute', maxAge)
+        if cached is not None:
+            return ProcessorState.Reply(cached)
+        return (await self.apollstate(maxAge))[1]
+
+    # Returns (fader, mute) Replies, asking the processor for whichever of them is older than maxAge.
+    # When both are needed they are pipelined, so it costs a single round trip.
+    # A failed read is recorded in the state cache's snapshot. A poll the rate limiter skipped
+    # (only possible with PRIORITY_BACKGROUND) isn't a failure and isn't recorded. A poll that
+    # worked clears the recorded error, even when the cache answered it.
+    async def apollstate(self, maxAge=None, priority=PRIORITY_POLL):
+        replies = {}
+        for name in ('fader', 'mute'):
+            # While the fader scheduler has a write coming, reading the fader back is pointless: the
+            # reply would be overwritten straight away. The level in the cache is used instead.
+            age = float('inf') if name == 'fader' and self.faderScheduler.busy else maxAge
+            cached = self.stateCache.get(name, age)
+            if cached is not None:
+                replies[name] = ProcessorState.Reply(cached)
+        names = [name for name in ('fader', 'mute') if name not in replies]
+        error = ProcessorState.ErrorCode.NONE
+        if names:
+            queries = {'fader': self.FADER_QUERY, 'mute': self.MUTE_QUERY}
+            texts = await self.asendmany([queries[name] for name in names], priority)
+            for name, text in zip(names, texts):
+                reply = replies[name] = self.decodereply(text)
+                if reply.ok:
+                    self.stateCache.put(name, reply.value)
+                elif reply.error != ProcessorState.ErrorCode.RATE_LIMITED:
+                    error = reply.error
+        if error or all(reply.ok for reply in replies.values()):
+            self.stateCache.seterror(error)
+        return replies['fader'], replies['mute']
+
+    # Polls the state for the display in the background, see apollstate. Returns the state cache's
+    # ProcessorState snapshot, or None if the rate limiter skipped the poll.
+    async def apoll(self, maxAge=None):
+        replies = await self.apollstate(maxAge, PRIORITY_BACKGROUND)
+        if any(reply.error == ProcessorState.ErrorCode.RATE_LIMITED for reply in replies):
+            return None
+        return self.stateCache.state
+
+    # The commands behind the methods above. These always go to the processor.
+    async def aqueryfader(self):
+        return self.decodereply(await self.asend(self.FADER_QUERY))
+
+    async def aquerymute(self):
+        return self.decodereply(await self.asend(self.MUTE_QUERY))
+
+    async def asendfader(self, value):
+        return self.decodereply(await self.asend(self.CODEC.write('fader', value), PRIORITY_WRITE, self.FADER_QUERY))
+
+    async def asendmute(self, mute=1):
+        return self.decodereply(await self.asend(self.CODEC.write('mute', mute), PRIORITY_MUTE, self.MUTE_QUERY))
+
+    async def agetversion(self):
+        query = self.CODEC.query('version')
+        if query is None:
+            return f'Version unavailable for {self.CODEC.name}'
+        return self.stripvalue(await self.asend(query))
+
+    # Returns the fader level the way the display shows it, e.g. ' 7.0', or False if it's unavailable
+    async def adisplayfader(self):
+        fader = await self.agetfader()
+        if(fader.ok):
+            return self.formatfader(fader.value)
+        else:
+            return False
+
+    # Formats a fader level (in processor units) for the display, e.g. 70 -> '  7.0'
+    def formatfader(self, fader):
+        rawfader = str(fader // self.FADER_STEP)
+        formattedfader = rawfader[:-1]+'.'+rawfader[-1:] #add decimal point one space over from the right
+        return f'{str(formattedfader).rjust(5," ")}'
+
+# The blocking API used by the rest of the program. Each method is a thin wrapper that runs
+# the matching coroutine on the shared event loop and waits for its result.
+# Never call these from the event loop thread itself, use the async methods there.
+class CinemaProcessor(AsyncCinemaProcessor):
+
+    # Schedules a coroutine on the shared event loop without waiting for it.
+    # Returns a concurrent.futures.Future that can be polled with done() and result().
+    def submit(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, getEventLoop())
+
+    # Runs a coroutine on the shared event loop and blocks until it has finished.
+    def run(self, coroutine):
+        return self.submit(coroutine).result()
+
     def getState(self):
-        pass
-    
-    @abstractmethod
+        return self.run(self.agetState())
+
     def connect(self):
-        pass
-    
-    @abstractmethod
+        return self.run(self.aconnect())
+
     def disconnect(self):
-        pass
-        
-    @abstractmethod
+        return self.run(self.adisconnect())
+
+    # Starts connecting in the background and returns straight away, see areconnect.
+    # The returned future is done once connected, cancel it to stop trying.
+    def reconnect(self):
+        return self.submit(self.areconnect())
+
     def send(self, command):
-        pass
-    
-    # This will probably need to be overridden, but it works for Dolby Cinema processors
-    # A response string is split by spaces and the last element (the response data) is returned.
-    # If it's an number, it's cast as an integer first.
-    # Return True if both values are numbers, False if there was an issue (like a timeout)
-    def stripvalue(self, responseText):
-        value = responseText.strip().split(" ")[-1]
-        if (value.isdigit()):
-            return int(value)
-        else:
-            return value
-        
+        return self.run(self.asend(command))
+
     def addfader(self, value=1):
-        currentFader = self.getfader()
-        if(isinstance(value, int) and isinstance(currentFader, int)):
-            newFader = currentFader + value
-            if(newFader<0):
-                self.setfader(0)
-            elif(newFader>100):
-                self.setfader(100)
-            else:
-                self.setfader(newFader)
-            return True
-        else:
-            return False
-                
-    @abstractmethod
-    def getfader(self):
-        pass
-    
-    @abstractmethod
+        return self.run(self.aaddfader(value))
+
+    def getfader(self, maxAge=None):
+        return self.run(self.agetfader(maxAge))
+
     def setfader(self, value):
-        pass
-    
-    @abstractmethod
+        return self.run(self.asetfader(value))
+
     def setmute(self, mute=1):
-        pass
-    
-    @abstractmethod
-    def getmute(self):
-        pass
-    
-    @abstractmethod
+        return self.run(self.asetmute(mute))
+
+    # Starts a fade and returns straight away, see afade
+    def fade(self, target, duration, curve='linear'):
+        return self.submit(self.afade(target, duration, curve))
+
+    def getmute(self, maxAge=None):
+        return self.run(self.agetmute(maxAge))
+
+    def getversion(self):
+        return self.run(self.agetversion())
+
     def displayfader(self):
-        pass
+        return self.run(self.adisplayfader())
+
+    def poll(self, maxAge=None):
+        return self.run(self.apoll(maxAge))
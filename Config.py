@@ -9,13 +9,98 @@ FILEPATH = "/home/pi/FTP/VolumeControl"
 # Polling/update delay in seconds
 # A lower delay will make the the fader more responsive, BUT if it is too low
 # the frequent requests to the Cinema Processor can be rejected, causing buggy responses.
+# This is the delay used right after the knob or keyboard was used. While idle, the delay grows
+# by POLLING_BACKOFF times after every poll, up to POLLING_MAX_DELAY. Errors and timeouts
+# slow polling down as well.
 POLLING_DELAY = 0.3
+POLLING_MAX_DELAY = 3.0
+POLLING_BACKOFF = 1.5
+
+# Number of failed polls in a row before reconnecting to the Cinema Processor
+POLLING_MAX_FAILURES = 3
+
+# Main loop delay in seconds
+# How often the encoder is checked and finished Cinema Processor requests are picked up.
+# This does not send anything to the Cinema Processor, so it can be much lower than POLLING_DELAY.
+LOOP_DELAY = 0.02
+
+# Fader write coalescing window in seconds
+# Knob and keyboard changes made within this window are added up and sent to the
+# Cinema Processor as a single fader level instead of one command per tick.
+WRITE_COALESCE_WINDOW = 0.05
+
+# Fader/mute cache lifetime in seconds
+# Fader and mute levels we have just set or read are reused for this long instead of asking
+# the Cinema Processor again. Changes made on the processor itself (or by another remote) will
+# show up on the display after at most this long plus POLLING_DELAY.
+STATE_CACHE_TTL = 1.0
+
+# Connecting
+# Seconds to wait for the Cinema Processor to accept a connection before giving up on that try.
+# While disconnected, connecting is retried in the background, starting after RECONNECT_DELAY
+# seconds and doubling the wait (with some randomness) after every failure up to
+# RECONNECT_MAX_DELAY. The display and keyboard keep working in the meantime.
+CONNECT_TIMEOUT = 2.0
+RECONNECT_DELAY = 0.25
+RECONNECT_MAX_DELAY = 1.0
+
+# Reply timeouts
+# How long to wait for a reply is worked out from how fast the processor has been answering,
+# but always stays between these two (in seconds). The minimum is RFC 6298's: waiting any less
+# turns a reply that was merely slow into a timeout.
+MIN_REPLY_TIMEOUT = 1.0
+MAX_REPLY_TIMEOUT = 5.0
+
+# Command rate limits
+# Commands per second (rate) and how many can go in a quick burst (burst) for each processor
+# model, so we can run close to what the processor takes without being rejected. Writes and
+# reads wait for their turn, background display polls are skipped when they would go over.
+# Each driver has its own default (RATE_LIMIT in its class); to change one, add it here as
+# 'MODEL': (rate, burst), e.g. {'CP750': (10, 4)}. Models are CP650, CP750, CP850, CP950, JSD60
+# and JSD100. The CP950 and JSD100 use the CP850's and JSD60's entries unless they have their own.
+RATE_LIMITS = {}
+
+# Command pipelining
+# When True, queries that are needed together (like the fader and mute levels) are sent in one go
+# and the replies are matched up afterwards, saving a round trip. A processor that keeps dropping
+# replies is switched back to one command at a time automatically (and tried again later, see
+# CinemaProcessor.PIPELINE_MAX_FAILURES); set this to False to never pipeline.
+PIPELINING = True
+
+# Metrics
+# Round trip times, timeouts, reconnects and traffic for the Cinema Processor are always counted.
+# Set METRICS_PORT to read them at http://METRICS_HOST:METRICS_PORT/metrics (or /metrics.json),
+# and/or METRICS_FILE to have them written there as JSON every METRICS_FLUSH_INTERVAL seconds.
+METRICS_HOST = "127.0.0.1"
+METRICS_PORT = None
+METRICS_FILE = None             # e.g. f'{FILEPATH}/logs/metrics.json'
+METRICS_FLUSH_INTERVAL = 60
 
 # Encoder Sensitivity
 # We had an encoder that incremented twice for one click, so we added this so we could
 # decrease the sensitivity to 0.5 for it.
 SENSITIVITY = 1
 
+# Encoder acceleration
+# Spinning the knob fast moves the fader in bigger steps, so a big change takes a few commands
+# instead of dozens. Each entry is (speed in encoder ticks per second, multiplier); the knob's
+# speed over the last ACCELERATION_WINDOW seconds picks a multiplier between the entries, which
+# multiplies SENSITIVITY. Below the first entry its multiplier is used, above the last entry the
+# last one. The multiplied steps are still 0.1 steps on the display, so a JSD gets the same
+# change as a Dolby. Set ACCELERATION = None to turn it off.
+ACCELERATION = ((100, 1), (300, 3), (600, 10))
+ACCELERATION_WINDOW = 0.1
+
+# Fade presets
+# Keys that fade the fader to a level over a number of seconds, e.g. at the end of the credits.
+# Each entry is 'key': (level as shown on the display, seconds, curve). Keys are pynput names
+# such as 'f5' or single characters; the curve is 'linear', 'ease', 'fast' or 'slow'.
+# Turning the knob or pressing a volume key stops a fade where it is.
+FADE_PRESETS = {
+    'f5': (4.0, 8, 'ease'),
+    'f6': (7.0, 8, 'ease'),
+}
+
 # Encoder pins
 # The pins that the rotary encoder (the knob) is connected to.
 # Unless you are rewiring the device pi, you should not need to touch this.
@@ -33,8 +118,16 @@ DISPLAYTYPE = 0
 CLK = 5
 DIO = 4
 
+# Glyph atlas for the big fader digits on the OLED
+# The digits are drawn once and saved here, so later starts don't need to run FreeType at all.
+# Delete the file after changing the font. Set to None to build the atlas in memory on every start.
+GLYPH_ATLAS = f'{FILEPATH}/fonts/cache/hack-34-atlas.png'
+
 # Ports for Cinema Processors
 # These shouldn't ever need to change
+# Set CPPORT to use a different port than the processor's usual one,
+# for example to point at ProcessorSimulator.py. None uses the usual port.
+CPPORT = None
 # DOLBYPORT = 61408       # port for Dolby CP_50 Cinema Processors
 # CP650PORT = 61412
 # JSDPORT = 10001         # port for JSD Cinema Processors
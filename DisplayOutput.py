@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+# Sends frames to the displays, skipping anything the display already shows.
+#
+# The OLED and the 7 segment displays hang off a slow I2C bus (or the bit-banged TM1637 bus),
+# and the main loop asks for the same frame over and over. Each output remembers what it last
+# sent, does nothing for an identical frame, and otherwise only writes the part that changed:
+# the dirty 8-pixel pages on the OLED, the changed digits on the segment displays.
+
+import logging
+
+LOGGER = logging.getLogger(__name__)
+
+# SSD1306 commands
+SET_COL_ADDR = 0x21
+SET_PAGE_ADDR = 0x22
+
+# Returns the first and last index where a and b differ, or None if they are the same
+def changedrange(a, b):
+    if a == b:
+        return None
+    first = 0
+    while a[first] == b[first]:
+        first += 1
+    last = len(a) - 1
+    while a[last] == b[last]:
+        last -= 1
+    return first, last
+
+# adafruit_ssd1306.SSD1306_I2C
+class OLEDOutput():
+    def __init__(self, display):
+        self.display = display
+        self.pageSize = display.width
+        self.last = None        # Copy of the display buffer as last sent, without the 0x40 control byte
+        # Writing single pages needs horizontal addressing over I2C, anything else gets a full show()
+        self.partial = hasattr(display, 'i2c_device') and not getattr(display, '_page_addressing', False) and display.width == 128
+
+    # Forget what the display shows, e.g. after drawing on it directly
+    def invalidate(self):
+        self.last = None
+
+    # Shows a PIL image. Returns True if anything was sent.
+    def show(self, image):
+        self.display.image(image)
+        frame = bytes(memoryview(self.display.buffer)[1:])
+        if frame == self.last:
+            return False
+        if not self.partial or self.last is None:
+            self.display.show()
+        else:
+            first, last = changedrange(frame, self.last)
+            firstPage, lastPage = first // self.pageSize, last // self.pageSize
+            self.display.write_cmd(SET_COL_ADDR)
+            self.display.write_cmd(0)
+            self.display.write_cmd(self.display.width - 1)
+            self.display.write_cmd(SET_PAGE_ADDR)
+            self.display.write_cmd(firstPage)
+            self.display.write_cmd(lastPage)
+            data = bytearray(1 + (lastPage - firstPage + 1)*self.pageSize)
+            data[0] = 0x40
+            data[1:] = frame[firstPage*self.pageSize:(lastPage + 1)*self.pageSize]
+            with self.display.i2c_device:
+                self.display.i2c_device.write(data)
+        self.last = frame
+        return True
+
+# adafruit_ht16k33.segments.Seg7x4, which must have auto_write turned off
+class HT16K33Output():
+    def __init__(self, display):
+        self.display = display
+        self.lastText = None
+        self.last = None        # Copy of the display RAM as last sent, without the address byte
+        # Newer adafruit_ht16k33 releases keep a list of devices (for chained displays), older
+        # versions a single one. Only a single display gets partial writes, anything else a full show().
+        device = getattr(display, 'i2c_device', None)
+        if isinstance(device, (list, tuple)):
+            device = device[0] if len(device) == 1 else None
+        self.device = device
+
+    def show(self, text):
+        if text == self.lastText:
+            return False
+        self.lastText = text
+        self.display.print(text)
+        buffer = getattr(self.display, '_buffer', None)
+        if buffer is None or self.device is None or self.last is None:
+            self.display.show()
+        else:
+            changed = changedrange(bytes(buffer[1:]), self.last)
+            if changed is None:
+                return False
+            first, last = changed
+            # Each digit is two bytes of display RAM, so only the changed digits go over the bus
+            with self.device:
+                self.device.write(bytes([first]) + bytes(buffer[1 + first:2 + last]))
+        if buffer is not None:
+            self.last = bytes(buffer[1:])
+        return True
+
+# tm1637.TM1637
+class TM1637Output():
+    def __init__(self, display):
+        self.display = display
+        self.last = None        # Segments as last sent
+
+    def show(self, text):
+        segments = self.display.encode_string(text.replace(".", ""))
+        if self.last is None or len(segments) != len(self.last):
+            self.display.write(segments)
+        else:
+            changed = changedrange(bytes(segments), self.last)
+            if changed is None:
+                return False
+            first, last = changed
+            self.display.write(segments[first:last + 1], first)
+        self.last = bytes(segments)
+        return True
@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+# Runs all display rendering and bus writes on a background thread.
+#
+# The main loop and the keyboard listener post what a display should show into a mailbox
+# with one slot per display, and return straight away. Posting again before the worker got
+# to it replaces the old value, so when the bus falls behind the in-between frames are
+# dropped and the display jumps to the latest state.
+
+import logging
+import threading
+
+LOGGER = logging.getLogger(__name__)
+
+# One slot per display, holding the latest value posted for it
+class Mailbox():
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.slots = {}
+        self.busy = False       # True while the worker is drawing what it took out last
+
+    def put(self, target, value):
+        with self.condition:
+            self.slots[target] = value
+            self.condition.notify_all()
+
+    # Waits for something to be posted, then empties the mailbox and returns {target: value}
+    def take(self):
+        with self.condition:
+            self.busy = False
+            self.condition.notify_all()
+            while not self.slots:
+                self.condition.wait()
+            slots = self.slots
+            self.slots = {}
+            self.busy = True
+            return slots
+
+    # Waits up to timeout seconds until everything posted has been drawn. Returns False on timeout.
+    def drain(self, timeout=None):
+        with self.condition:
+            return self.condition.wait_for(lambda: not self.slots and not self.busy, timeout)
+
+class DisplayWorker():
+    # handlers maps each target name to a function that draws a posted value on that display
+    def __init__(self, handlers):
+        self.handlers = handlers
+        self.mailbox = Mailbox()
+        self.thread = threading.Thread(target=self.run, name='DisplayWorker', daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    # Hands a value to the worker. Never blocks on the display.
+    def post(self, target, value):
+        self.mailbox.put(target, value)
+
+    # Waits until everything posted so far is on the displays
+    def flush(self, timeout=5):
+        if not self.mailbox.drain(timeout):
+            LOGGER.warning('Timed out waiting for the displays to update')
+
+    def run(self):
+        while True:
+            for target, value in self.mailbox.take().items():
+                try:
+                    self.handlers[target](value)
+                except Exception as ex:
+                    LOGGER.exception("Display update error (%s): %s", target, ex)
@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+# Fades the fader to a level over a set time, e.g. down to 4.0 over 8 seconds at the end of the credits.
+#
+# The fade is written as a series of absolute levels, no faster than half the processor's
+# rate limit (the rest is left for polls and the knob) and never more than one write per
+# fader step. Turning the knob or pressing a volume key cancels the fade straight away, and
+# the fader stays wherever the fade had got to.
+
+import asyncio
+import logging
+import time
+
+LOGGER = logging.getLogger(__name__)
+
+# How far along the fade the level is (0 to 1) at each point in time (0 to 1)
+CURVES = {
+    'linear': lambda t: t,
+    'ease': lambda t: t*t*(3 - 2*t),        # Starts and ends gently
+    'fast': lambda t: 1 - (1 - t)*(1 - t),  # Most of the change early on, then settles
+    'slow': lambda t: t*t,                  # Gentle start, most of the change at the end
+}
+
+class FaderRamp():
+    def __init__(self, cp):
+        self.cp = cp
+        self.task = None
+
+    # True while a fade is running
+    @property
+    def active(self):
+        return self.task is not None and not self.task.done()
+
+    # Starts fading to target (in processor units, like asetfader) over duration seconds, replacing
+    # any fade already running. Returns the task, which ends with True once the target is reached.
+    # Must be called on the event loop.
+    def start(self, target, duration, curve='linear'):
+        self.cancel()
+        self.task = asyncio.get_running_loop().create_task(self.run(target, duration, CURVES[curve]))
+        return self.task
+
+    def cancel(self):
+        if self.active:
+            LOGGER.info('Fade cancelled')
+            self.task.cancel()
+
+    async def run(self, target, duration, curve):
+        target = self.cp.faderScheduler.clamp(target)
+        reply = await self.cp.agetfader()
+        if not reply.ok:
+            LOGGER.warning(f'Can\'t fade, fader unavailable: {reply.text}')
+            return False
+        start = reply.value
+        steps = abs(target - start) // self.cp.FADER_STEP
+        if not steps or duration <= 0:
+            return (await self.cp.asetfader(target)).ok
+        interval = max(duration / steps, 2 / self.cp.rateLimiter.rate)
+        LOGGER.info(f'Fading from {start} to {target} over {duration}s')
+
+        began = time.monotonic()
+        level = start
+        while level != target:
+            progress = min(1.0, (time.monotonic() - began) / duration)
+            # Always land on a whole fader step
+            nextLevel = start + round((target - start) * curve(progress) / self.cp.FADER_STEP) * self.cp.FADER_STEP
+            if progress >= 1.0:
+                nextLevel = target
+            if nextLevel != level:
+                result = await self.cp.asetfader(nextLevel)
+                if not result.ok:
+                    LOGGER.warning(f'Fade stopped, fader write failed: {result.text}')
+                    return False
+                level = nextLevel
+            if level != target:
+                await asyncio.sleep(interval)
+        return True
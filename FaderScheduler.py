@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+# Coalesces fader changes from the encoder and the keyboard into as few writes as possible.
+#
+# Instead of reading the fader and writing it back for every tick, the changes are added up
+# for a short window and only the latest absolute level is sent to the Cinema Processor.
+# Changes that arrive while a write is on the wire are folded into the next write, so the
+# last write always wins and no stale levels pile up.
+
+import asyncio
+import logging
+
+import Config
+
+LOGGER = logging.getLogger(__name__)
+
+class FaderScheduler():
+    def __init__(self, cp, window=Config.WRITE_COALESCE_WINDOW):
+        self.cp = cp
+        self.window = window            # Seconds to collect changes before writing
+        self.target = None              # Locally tracked fader level in processor units, None if unknown
+        self.pendingDelta = 0           # Changes (in fader steps) that haven't been written yet
+        self.flushTask = None
+
+    # True while a fader read would be useless because it is about to be overwritten
+    @property
+    def busy(self):
+        return self.flushTask is not None
+
+    # Adds value fader steps (0.1 on the display) to the fader. Must be called on the event loop.
+    # A running fade is cancelled, the knob and the keyboard always take over.
+    def add(self, value):
+        if not isinstance(value, int):
+            return False
+        self.cp.faderRamp.cancel()
+        self.pendingDelta += value
+        if self.flushTask is None:
+            self.flushTask = asyncio.get_running_loop().create_task(self.flush())
+        return True
+
+    # Seconds to collect changes before writing. On a slow network changes are collected for up to
+    # half a round trip, they would only queue up behind each other on the wire otherwise.
+    def collectfor(self):
+        rtt = self.cp.rtt.srtt
+        if rtt is None:
+            return self.window
+        return min(4 * self.window, max(self.window, rtt / 2))
+
+    # Clamps a level to what the processor accepts
+    def clamp(self, level):
+        return max(0, min(self.cp.FADER_MAX, level))
+
+    async def flush(self):
+        try:
+            await asyncio.sleep(self.collectfor())
+            while self.pendingDelta:
+                if self.target is None:
+                    currentFader = await self.cp.agetfader()
+                    if not currentFader.ok:
+                        # Swallow any fader changes made during connection difficulty
+                        LOGGER.warning(f'Dropping fader change of {self.pendingDelta}, fader unavailable: {currentFader.text}')
+                        self.pendingDelta = 0
+                        return False
+                    self.target = currentFader.value
+
+                self.target = self.clamp(self.target + self.pendingDelta*self.cp.FADER_STEP)
+                self.pendingDelta = 0
+                # Optimistically show the new level before the processor has confirmed it
+                self.cp.stateCache.put('fader', self.target)
+                result = await self.cp.asetfader(self.target)
+                if not result.ok:
+                    LOGGER.warning(f'Fader write failed: {result.text}')
+                    self.cp.stateCache.invalidate('fader')
+                    self.target = None
+                    self.pendingDelta = 0
+                    return False
+
+                # Trust the processor if it rounded or clamped the level
+                self.target = result.value
+            return True
+        finally:
+            self.flushTask = None
+            # The target is only tracked for the length of a burst, the next one starts from the state cache
+            self.target = None
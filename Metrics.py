@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+# Counters and latency histograms for Cinema Processor traffic.
+#
+# Every CinemaProcessor records the round trip time of each command (grouped by command type),
+# timeouts, errors, connects and reconnects, and bytes sent and received. The numbers can be
+# read over HTTP (Prometheus text format on /metrics, JSON on /metrics.json) if
+# Config.METRICS_PORT is set, and/or written to Config.METRICS_FILE every
+# Config.METRICS_FLUSH_INTERVAL seconds, so responsiveness can be followed through a day of shows.
+
+import json
+import logging
+import os
+import re
+import threading
+import time
+
+import Config
+
+LOGGER = logging.getLogger(__name__)
+
+# Upper bounds of the round trip time buckets, in seconds
+RTT_BUCKETS = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0, 2.0, 5.0)
+
+# name -> ProcessorMetrics, so the exporters can find them
+_registry = {}
+_registryLock = threading.Lock()
+
+class Histogram():
+    def __init__(self, buckets=RTT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # The last count is for anything above the last bucket
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        index = 0
+        while index < len(self.buckets) and value > self.buckets[index]:
+            index += 1
+        self.counts[index] += 1
+        self.count += 1
+        self.sum += value
+
+    def snapshot(self):
+        return {
+            'buckets': dict(zip([str(bound) for bound in self.buckets] + ['+Inf'], self.counts)),
+            'count': self.count,
+            'sum': self.sum,
+        }
+
+# Groups commands that only differ in the value they set, e.g. "cp750.sys.fader 70" -> "cp750.sys.fader N"
+def commandtype(command):
+    return re.sub(r'[-+]?\d+$', 'N', command.strip()).replace('\t', ' ')
+
+class ProcessorMetrics():
+    def __init__(self, name):
+        self.name = name
+        self.started = time.time()
+        self.rtt = {}                   # command type -> Histogram of round trip times in seconds
+        self.commands = 0
+        self.timeouts = 0
+        self.errors = 0
+        self.connects = 0
+        self.reconnects = 0
+        self.connectFailures = 0
+        self.superseded = 0             # Queued polls answered by a write instead of being sent
+        self.rateLimitWaits = 0         # Commands that waited for the rate limiter
+        self.rateLimitWaitSeconds = 0.0
+        self.rateLimitRejects = 0       # Polls skipped by the rate limiter
+        self.bytesOut = 0
+        self.bytesIn = 0
+        self.srtt = None                # Smoothed round trip time in seconds, None until measured
+        self.rto = None                 # Current reply timeout in seconds
+
+    def observe(self, command, seconds):
+        label = getattr(command, 'label', None) or commandtype(command)
+        if label not in self.rtt:
+            self.rtt[label] = Histogram()
+        self.rtt[label].observe(seconds)
+        self.commands += 1
+
+    def connected(self):
+        if self.connects:
+            self.reconnects += 1
+        self.connects += 1
+
+    def snapshot(self):
+        return {
+            'processor': self.name,
+            'uptime': time.time() - self.started,
+            'commands': self.commands,
+            'timeouts': self.timeouts,
+            'errors': self.errors,
+            'connects': self.connects,
+            'reconnects': self.reconnects,
+            'connectFailures': self.connectFailures,
+            'superseded': self.superseded,
+            'rateLimitWaits': self.rateLimitWaits,
+            'rateLimitWaitSeconds': self.rateLimitWaitSeconds,
+            'rateLimitRejects': self.rateLimitRejects,
+            'bytesOut': self.bytesOut,
+            'bytesIn': self.bytesIn,
+            'srtt': self.srtt,
+            'rto': self.rto,
+            'rtt': {label: histogram.snapshot() for label, histogram in list(self.rtt.items())},
+        }
+
+# Returns the metrics for the named processor. The same object is handed out every time, so the
+# counts carry on when VolumeControl makes a new CinemaProcessor to reconnect.
+def processor(name):
+    with _registryLock:
+        if name not in _registry:
+            _registry[name] = ProcessorMetrics(name)
+        return _registry[name]
+
+def snapshot():
+    with _registryLock:
+        processors = list(_registry.values())
+    return {'time': time.time(), 'processors': [metrics.snapshot() for metrics in processors]}
+
+# Formats the current numbers in the Prometheus text exposition format
+def prometheus():
+    lines = []
+    counters = (('commands', 'commands_total'), ('timeouts', 'timeouts_total'), ('errors', 'errors_total'),
+                ('connects', 'connects_total'), ('reconnects', 'reconnects_total'),
+                ('connectFailures', 'connect_failures_total'), ('superseded', 'superseded_polls_total'),
+                ('rateLimitWaits', 'rate_limit_waits_total'), ('rateLimitWaitSeconds', 'rate_limit_wait_seconds_total'),
+                ('rateLimitRejects', 'rate_limit_rejects_total'), ('bytesOut', 'bytes_out_total'),
+                ('bytesIn', 'bytes_in_total'))
+    processors = snapshot()['processors']
+    for key, name in counters:
+        lines.append(f'# TYPE cinemaprocessor_{name} counter')
+        for processor in processors:
+            lines.append(f'cinemaprocessor_{name}{{processor="{processor["processor"]}"}} {processor[key]}')
+    for key, name in (('srtt', 'smoothed_rtt_seconds'), ('rto', 'reply_timeout_seconds')):
+        lines.append(f'# TYPE cinemaprocessor_{name} gauge')
+        for processor in processors:
+            if processor[key] is not None:
+                lines.append(f'cinemaprocessor_{name}{{processor="{processor["processor"]}"}} {processor[key]}')
+    lines.append('# TYPE cinemaprocessor_rtt_seconds histogram')
+    for processor in processors:
+        for label, histogram in processor['rtt'].items():
+            labels = f'processor="{processor["processor"]}",command="{label}"'
+            cumulative = 0
+            for bound, count in histogram['buckets'].items():
+                cumulative += count
+                lines.append(f'cinemaprocessor_rtt_seconds_bucket{{{labels},le="{bound}"}} {cumulative}')
+            lines.append(f'cinemaprocessor_rtt_seconds_sum{{{labels}}} {histogram["sum"]}')
+            lines.append(f'cinemaprocessor_rtt_seconds_count{{{labels}}} {histogram["count"]}')
+    return '\n'.join(lines) + '\n'
+
+# Serves the metrics over HTTP. http.server is only imported when this is turned on, it takes
+# longer to load than the rest of the program together.
+def serve(host, port):
+    import http.server
+
+    class MetricsHandler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path == '/metrics':
+                body = prometheus().encode('UTF-8')
+                contentType = 'text/plain; version=0.0.4'
+            elif self.path == '/metrics.json':
+                body = json.dumps(snapshot()).encode('UTF-8')
+                contentType = 'application/json'
+            else:
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header('Content-Type', contentType)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        # Keep scrapes out of the log
+        def log_message(self, format, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name='MetricsServer', daemon=True).start()
+
+def writeFile(path):
+    # Write to a temporary file first so a reader never sees half a file
+    temporary = f'{path}.tmp'
+    with open(temporary, 'w') as file:
+        json.dump(snapshot(), file, indent=1)
+    os.replace(temporary, path)
+
+def flushLoop(path, interval):
+    while True:
+        time.sleep(interval)
+        try:
+            writeFile(path)
+        except Exception as ex:
+            LOGGER.exception("Metrics file write error: %s", ex)
+
+# Starts whichever exporters are turned on in Config. Safe to call if none are.
+def startExporter():
+    if Config.METRICS_PORT:
+        try:
+            serve(Config.METRICS_HOST, Config.METRICS_PORT)
+            LOGGER.info(f'Serving metrics on http://{Config.METRICS_HOST}:{Config.METRICS_PORT}/metrics')
+        except Exception as ex:
+            LOGGER.exception("Metrics server error: %s", ex)
+    if Config.METRICS_FILE:
+        threading.Thread(target=flushLoop, args=(Config.METRICS_FILE, Config.METRICS_FLUSH_INTERVAL),
+                         name='MetricsFile', daemon=True).start()
@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+# Draws the OLED screens into one preallocated 1-bit frame buffer.
+#
+# Fonts are loaded once, and each screen layout is a fixed set of text lines. When the same
+# layout is drawn again only the lines whose text changed and the lines next to them are
+# cleared and redrawn, so the frame itself and the rest of the status screen are reused between calls.
+#
+# The big fader readout only ever uses a handful of characters, so those are rasterised once
+# into a glyph atlas (optionally saved as a PNG, see Config.GLYPH_ATLAS) and copied into the
+# frame instead of running FreeType on every update.
+
+import logging
+import math
+import os
+
+from PIL import Image, ImageDraw, ImageFont, PngImagePlugin
+
+LOGGER = logging.getLogger(__name__)
+
+# Everything the fader readout and print7seg() can show
+ATLAS_GLYPHS = "0123456789. -E"
+# Blank columns left of each glyph in its atlas cell, in case a glyph starts left of its origin
+ATLAS_MARGIN = 1
+
+# Screen layouts: name -> ((x, y, font), ...), one entry per line of text.
+# The y positions include the -2 padding the display has always used.
+LAYOUTS = {
+    # The fader level in big digits (CONNECTED when there is no separate 7 segment display)
+    'fader': ((0, -2, 'large'),),
+    # CP TYPE, CPIP, OWNIP and the input/message line
+    'status': ((0, -2, 'small'), (0, 6, 'small'), (0, 14, 'small'), (0, 23, 'small')),
+}
+
+class OLEDRenderer():
+    def __init__(self, width, height, fontPath, fontSize=34, atlasPath=None):
+        self.width = width
+        self.height = height
+        self.image = Image.new("1", (width, height))    # 1-bit color image to write on.
+        self.draw = ImageDraw.Draw(self.image)
+        self.fontPath = fontPath
+        self.fontSize = fontSize
+        self.fonts = {'small': ImageFont.load_default()}
+        self.atlas = GlyphAtlas(self, atlasPath)
+        self.layout = None      # Layout currently in the frame buffer
+        self.texts = ()         # Text currently drawn on each line of that layout
+
+    # Draws texts (one per line of the layout) into self.image.
+    # Returns True if anything changed since the last call.
+    def render(self, layout, texts):
+        lines = LAYOUTS[layout]
+        texts = tuple(texts)
+        if layout != self.layout:
+            self.draw.rectangle((0, 0, self.width, self.height), outline=0, fill=0)
+            changed = set(range(len(lines)))
+        else:
+            changed = {index for index in range(len(lines)) if texts[index] != self.texts[index]}
+        if not changed:
+            return False
+
+        # Each line owns the band of rows down to where the next line starts. Glyphs can poke a few
+        # pixels into the neighbouring bands, so the neighbours' bands are cleared as well (or the old
+        # glyphs' overhang would stay), and their neighbours drawn again for what they put into them.
+        neighbours = lambda indexes: {neighbour for index in indexes for neighbour in (index - 1, index, index + 1)
+                                      if 0 <= neighbour < len(lines)}
+        cleared = neighbours(changed)
+        if layout == self.layout:
+            for index in cleared:
+                top = 0 if index == 0 else lines[index][1]
+                bottom = self.height if index == len(lines) - 1 else lines[index + 1][1]
+                self.draw.rectangle((0, top, self.width, bottom - 1), outline=0, fill=0)
+        for index in sorted(neighbours(cleared)):
+            x, y, font = lines[index]
+            if font == 'large' and self.atlas.covers(texts[index]):
+                self.atlas.blit(self.image, x, texts[index])
+            else:
+                self.draw.text((x, y), texts[index], font=self.font(font), fill=255)
+
+        self.layout = layout
+        self.texts = texts
+        return True
+
+    # Returns a font, loading the big one the first time it is needed
+    def font(self, name):
+        if name not in self.fonts:
+            self.fonts[name] = ImageFont.truetype(self.fontPath, self.fontSize)
+        return self.fonts[name]
+
+# The ATLAS_GLYPHS drawn in the big font, each one in its own full height cell, laid out in a
+# strip so the whole atlas is a single image. Cells hold the glyph exactly where the 'fader'
+# layout would draw it, so copying a cell to (x, 0) gives the same result as drawing the text.
+class GlyphAtlas():
+    def __init__(self, renderer, path=None):
+        self.glyphs = {}
+        self.advance = 0
+        strip = self.load(path, renderer.height) if path else None
+        if strip is None:
+            strip = self.build(renderer)
+            if path:
+                self.save(strip, path)
+        cellWidth = strip.width // len(ATLAS_GLYPHS)
+        for index, character in enumerate(ATLAS_GLYPHS):
+            self.glyphs[character] = strip.crop((index*cellWidth, 0, (index + 1)*cellWidth, strip.height))
+
+    # Rasterises every glyph with FreeType. Only needed once, or never if the atlas was saved.
+    def build(self, renderer):
+        font = renderer.font('large')
+        _, y, _ = LAYOUTS['fader'][0]
+        self.advance = font.getlength('0')
+        cellWidth = math.ceil(self.advance) + 2*ATLAS_MARGIN
+        strip = Image.new("1", (cellWidth*len(ATLAS_GLYPHS), renderer.height))
+        draw = ImageDraw.Draw(strip)
+        for index, character in enumerate(ATLAS_GLYPHS):
+            draw.text((index*cellWidth + ATLAS_MARGIN, y), character, font=font, fill=255)
+        return strip
+
+    def load(self, path, height):
+        if not os.path.exists(path):
+            return None
+        try:
+            strip = Image.open(path)
+            strip.load()
+            if strip.height != height or strip.width % len(ATLAS_GLYPHS) or 'advance' not in strip.info:
+                LOGGER.info(f'Ignoring glyph atlas {path}, it doesn\'t fit this display')
+                return None
+            self.advance = float(strip.info['advance'])
+            return strip.convert("1")
+        except Exception as ex:
+            LOGGER.exception("Glyph atlas read error: %s", ex)
+            return None
+
+    def save(self, strip, path):
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            info = PngImagePlugin.PngInfo()
+            info.add_text('advance', str(self.advance))
+            strip.save(path, pnginfo=info)
+        except Exception as ex:
+            LOGGER.exception("Glyph atlas save error: %s", ex)
+
+    def covers(self, text):
+        return all(character in self.glyphs for character in text)
+
+    # Copies the glyphs for text into image, starting at x. Only lit pixels are copied,
+    # so neighbouring glyphs can't blank each other out.
+    def blit(self, image, x, text):
+        for index, character in enumerate(text):
+            if character != ' ':
+                glyph = self.glyphs[character]
+                image.paste(255, (x + round(index*self.advance) - ATLAS_MARGIN, 0), mask=glyph)
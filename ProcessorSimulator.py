@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+# A stand-in for a real Cinema Processor, for testing and benchmarking away from the booth.
+#
+# It speaks the three dialects our drivers use:
+#   dolby  "cp750.sys.fader ?" / "sys.fader 70"            port 61408 (CP750, CP850/950)
+#   cp650  "fader_level=?" / "fader_level=70"              port 61412 (CP650)
+#   jsd    "jsd60.sys.fader" / "jsd60.sys.fader<TAB>700"   port 10001 (JSD60, JSD100)
+#
+# Latency, jitter, TCP segmentation, dropped replies, rate limiting and a connection cap can all
+# be configured, so the drivers can be tried against a slow or badly behaved processor.
+# Run it with: python3 ProcessorSimulator.py --help
+# Then point the drivers (or VolumeControl, see Config.CPPORT) at 127.0.0.1.
+
+import argparse
+import asyncio
+import collections
+import logging
+import random
+import time
+
+LOGGER = logging.getLogger(__name__)
+
+# What the simulator answers with when it is rate limiting. Real processors vary, but none of
+# them answer with a number, so the drivers treat it as an error.
+BUSY = 'busy'
+
+class SimulatedProcessor():
+    def __init__(self, dialect, latency=0.0, jitter=0.0, segmentSize=0, segmentDelay=0.001,
+                 dropRate=0.0, rateLimit=0, maxConnections=0, seed=None):
+        if dialect not in DIALECTS:
+            raise ValueError(f'Unknown dialect {dialect}, expected one of {", ".join(DIALECTS)}')
+        self.dialect = dialect
+        self.port, self.handler, self.faderMax = DIALECTS[dialect]
+        self.latency = latency              # Seconds before each reply
+        self.jitter = jitter                # Up to this many seconds are randomly added to or taken off the latency
+        self.segmentSize = segmentSize      # If set, replies are written in pieces of this many bytes
+        self.segmentDelay = segmentDelay    # Seconds between the pieces
+        self.dropRate = dropRate            # Fraction of commands that never get a reply
+        self.rateLimit = rateLimit          # Commands per second before replying BUSY, 0 for no limit
+        self.maxConnections = maxConnections    # Connections beyond this are closed straight away, 0 for no limit
+        self.random = random.Random(seed)
+
+        # Processor state, in the dialect's own units
+        self.state = {'fader': 7 * self.faderMax // 10, 'mute': 0, 'version': 1}
+
+        # Statistics
+        self.connections = 0
+        self.commandCount = 0
+        self.dropped = 0
+        self.rejected = 0
+        self.recent = collections.deque()   # time.monotonic() of commands in the last second, for rate limiting
+        self.log = collections.deque(maxlen=100000)     # (time.perf_counter(), command) of every command received
+        self.server = None
+        self.writers = set()                # Open client connections
+
+    async def start(self, host='127.0.0.1', port=None):
+        self.server = await asyncio.start_server(self.serve, host, self.port if port is None else port)
+        self.port = self.server.sockets[0].getsockname()[1]
+        LOGGER.info(f'Simulating a {self.dialect} processor on {host}:{self.port}')
+        return self.server
+
+    # Stops listening and drops every open connection, like a processor being switched off
+    async def stop(self):
+        if self.server is not None:
+            self.server.close()
+            for writer in list(self.writers):
+                writer.close()
+            await self.server.wait_closed()
+            self.server = None
+
+    async def serve(self, reader, writer):
+        if self.maxConnections and self.connections >= self.maxConnections:
+            LOGGER.info('Connection refused, too many connections')
+            writer.close()
+            return
+        self.connections += 1
+        self.writers.add(writer)
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                command = line.decode('UTF-8').strip()
+                if not command:
+                    continue
+                reply = self.execute(command)
+                delay = self.latency + self.random.uniform(-self.jitter, self.jitter)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                if reply is None:
+                    continue
+                data = reply.encode('UTF-8') + b'\r\n'
+                if self.segmentSize:
+                    for start in range(0, len(data), self.segmentSize):
+                        writer.write(data[start:start + self.segmentSize])
+                        await writer.drain()
+                        await asyncio.sleep(self.segmentDelay)
+                else:
+                    writer.write(data)
+                    await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            self.connections -= 1
+            self.writers.discard(writer)
+            writer.close()
+
+    # Works out the reply to one command, or None if the reply gets dropped
+    def execute(self, command):
+        now = time.monotonic()
+        self.commandCount += 1
+        self.log.append((time.perf_counter(), command))
+        if self.dropRate and self.random.random() < self.dropRate:
+            self.dropped += 1
+            return None
+        if self.rateLimit:
+            while self.recent and now - self.recent[0] > 1:
+                self.recent.popleft()
+            if len(self.recent) >= self.rateLimit:
+                self.rejected += 1
+                return self.handler(self, command, busy=True)
+            self.recent.append(now)
+        return self.handler(self, command)
+
+    # Sets or reads a state value. value is the text after the parameter name, '?' or '' to read.
+    def access(self, name, value):
+        if name == 'fader_delta':
+            name, value = 'fader', str(self.state['fader'] + int(value))
+        if name not in self.state:
+            return None
+        if value not in ('', '?'):
+            if name == 'version':
+                return None
+            level = int(value)
+            if name == 'fader':
+                level = max(0, min(self.faderMax, level))
+            else:
+                level = 1 if level else 0
+            self.state[name] = level
+        return self.state[name]
+
+# Dolby: "<prefix>.sys.fader ?" is answered with "<prefix>.sys.fader 70"
+def dolbyCommand(sim, command, busy=False):
+    parameter, _, value = command.partition(' ')
+    if busy:
+        return f'{parameter} {BUSY}'
+    try:
+        result = sim.access(parameter.split('.')[-1], value.strip())
+    except ValueError:
+        result = None
+    return f'{parameter} {"?" if result is None else result}'
+
+# CP650: "fader_level=?" is answered with "fader_level=70"
+def cp650Command(sim, command, busy=False):
+    parameter, _, value = command.partition('=')
+    if busy:
+        return f'{parameter}={BUSY}'
+    name = 'fader' if parameter == 'fader_level' else parameter
+    try:
+        result = sim.access(name, value.strip())
+    except ValueError:
+        result = None
+    return f'{parameter}={"?" if result is None else result}'
+
+# JSD: "jsd60.sys.fader" or "jsd60.sys.fader<TAB>700" are answered with just "700"
+def jsdCommand(sim, command, busy=False):
+    parameter, _, value = command.partition('\t')
+    if busy:
+        return BUSY
+    try:
+        result = sim.access(parameter.split('.')[-1], value.strip())
+    except ValueError:
+        result = None
+    return '?' if result is None else str(result)
+
+# dialect -> (default port, command handler, highest fader value)
+DIALECTS = {
+    'dolby': (61408, dolbyCommand, 100),
+    'cp650': (61412, cp650Command, 100),
+    'jsd': (10001, jsdCommand, 1000),
+}
+
+async def serve(args):
+    dialects = list(DIALECTS) if args.dialect == 'all' else [args.dialect]
+    simulators = []
+    for dialect in dialects:
+        sim = SimulatedProcessor(dialect, latency=args.latency, jitter=args.jitter,
+                                 segmentSize=args.segment, dropRate=args.drop, rateLimit=args.rate_limit,
+                                 maxConnections=args.max_connections, seed=args.seed)
+        await sim.start(args.host, args.port if len(dialects) == 1 else None)
+        print(f'{dialect} processor listening on {args.host}:{sim.port}')
+        simulators.append(sim)
+    try:
+        await asyncio.Event().wait()
+    finally:
+        for sim in simulators:
+            print(f'{sim.dialect}: {sim.commandCount} commands, {sim.dropped} dropped, {sim.rejected} rejected')
+
+def main():
+    parser = argparse.ArgumentParser(description='Simulates a Cinema Processor on the local network.')
+    parser.add_argument('--dialect', choices=['all'] + list(DIALECTS), default='all')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=None, help='defaults to the dialect\'s usual port')
+    parser.add_argument('--latency', type=float, default=0.005, help='seconds before each reply')
+    parser.add_argument('--jitter', type=float, default=0.0, help='random +/- seconds added to the latency')
+    parser.add_argument('--segment', type=int, default=0, help='split replies into pieces of this many bytes')
+    parser.add_argument('--drop', type=float, default=0.0, help='fraction of replies to drop')
+    parser.add_argument('--rate-limit', type=int, default=0, help='commands per second before replying busy')
+    parser.add_argument('--max-connections', type=int, default=0)
+    parser.add_argument('--seed', type=int, default=None)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    try:
+        asyncio.run(serve(args))
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+# Typed fader/mute state and command results.
+#
+# Replies from the Cinema Processor arrive as text and errors travel as strings starting with
+# CinemaProcessor.ERROR_PREFIX. They are turned into a Reply (a value or an error code) once,
+# where they are parsed, and the state cache keeps a ProcessorState snapshot that observers are
+# handed whenever it changes, so nothing further along has to look at strings.
+
+import enum
+
+class ErrorCode(enum.IntEnum):
+    NONE = 0
+    TIMEOUT = 1             # No reply in time
+    NO_RESPONSE = 2         # The processor skipped the command while pipelining
+    DISCONNECTED = 3        # Not connected and connecting failed
+    RATE_LIMITED = 4        # Held back by the rate limiter (see RateLimiter)
+    CONNECTION = 5          # Any other network or socket error
+    BAD_REPLY = 6           # The reply didn't hold a number, e.g. the processor said it was busy
+    CANCELLED = 7
+
+# The outcome of one command: value is the number the processor answered with, or None if error isn't NONE
+class Reply():
+    __slots__ = ('value', 'error', 'text')
+
+    def __init__(self, value=None, error=ErrorCode.NONE, text=None):
+        self.value = value
+        self.error = error
+        self.text = text        # The reply or error string, for the log
+
+    @property
+    def ok(self):
+        return self.error == ErrorCode.NONE
+
+    def __repr__(self):
+        return f'Reply({self.value!r}, {self.error.name}, {self.text!r})'
+
+# What is known about the processor: the fader and mute levels (None until known), the
+# time.monotonic() of the last change, and the error from the last failed read (NONE once a
+# read worked again). Snapshots are never changed, a new one is made for every change.
+class ProcessorState():
+    __slots__ = ('fader', 'mute', 'timestamp', 'error')
+
+    def __init__(self, fader=None, mute=None, timestamp=0.0, error=ErrorCode.NONE):
+        self.fader = fader
+        self.mute = mute
+        self.timestamp = timestamp
+        self.error = error
+
+    @property
+    def ok(self):
+        return self.error == ErrorCode.NONE and self.fader is not None
+
+    def __repr__(self):
+        return f'ProcessorState(fader={self.fader}, mute={self.mute}, timestamp={self.timestamp:.3f}, error={self.error.name})'
@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+# What each Cinema Processor model's commands and replies look like.
+#
+# The supported processors all speak the same kind of line protocol and only differ in the
+# parameter names, the character between a parameter and its value ('=', space or tab), how a
+# query is written and whether the reply repeats the parameter name. Each model is one Codec in
+# CODECS; adding a model means adding an entry there (and a driver class pointing at it).
+#
+# The queries are encoded once, when the table is built. Writes are built in a buffer that is
+# reused for every write and then kept, so sending a command doesn't build and encode a new
+# string each time.
+
+import ProcessorState
+
+LINE_END = b'\r\n'
+
+# A command ready to send: the text (for logs, metrics and matching replies) with its bytes
+# already encoded in data and its metrics label (see Metrics.commandtype) in label.
+class Command(str):
+    def __new__(cls, text, data=None, label=None):
+        command = super().__new__(cls, text)
+        command.data = data if data is not None else text.encode('UTF-8') + LINE_END
+        command.label = label
+        return command
+
+class Codec():
+    # name       model name, e.g. 'CP750'
+    # parameters {'fader': ..., 'mute': ..., 'version': ...} parameter names, version is optional
+    # separator  what goes between a parameter and its value
+    # query      what follows the separator to ask for a value, None if a query is just the parameter name
+    # echo       True if replies start with the parameter name, False if they are just the value
+    # faderStep  how much one step of the knob (0.1 on the display) moves the fader
+    # faderMax   the highest fader value
+    def __init__(self, name, parameters, separator=' ', query='?', echo=True, faderStep=1, faderMax=100):
+        self.name = name
+        self.parameters = parameters
+        self.separator = separator
+        self.echo = echo
+        self.faderStep = faderStep
+        self.faderMax = faderMax
+        self.queries = {}       # parameter name -> Command asking for it
+        self.prefixes = {}      # parameter name -> text up to the value when setting it
+        self.buffers = {}       # parameter name -> reusable bytearray starting with the encoded prefix
+        self.writes = {}        # (parameter name, value) -> Command, see write()
+        for key, parameter in parameters.items():
+            text = parameter if query is None else f'{parameter}{separator}{query}'
+            self.queries[key] = Command(text, label=text)
+            self.prefixes[key] = f'{parameter}{separator}'
+            self.buffers[key] = bytearray(self.prefixes[key].encode('UTF-8'))
+
+    def query(self, key):
+        return self.queries.get(key)
+
+    # Returns the Command setting parameter key to the integer value.
+    # Values only go up to faderMax, so every write is built once and kept for the next time.
+    def write(self, key, value):
+        command = self.writes.get((key, value))
+        if command is None:
+            command = self.writes[key, value] = self.build(key, value)
+        return command
+
+    def build(self, key, value):
+        prefix = self.prefixes[key]
+        buffer = self.buffers[key]
+        del buffer[len(prefix):]
+        buffer += b'%d' % value
+        buffer += LINE_END
+        return Command(prefix + str(value), bytes(buffer), (prefix + 'N').replace('\t', ' '))
+
+    # Returns the value in a reply, as an integer if it is a number. Error strings are passed on whole.
+    def parse(self, reply, errorPrefix):
+        if reply.startswith(errorPrefix):
+            return reply
+        value = reply.strip()
+        if self.echo:
+            value = value.split(self.separator)[-1]
+        if value.isdigit():
+            return int(value)
+        return value
+
+    # Returns the reply as a ProcessorState.Reply, with error BAD_REPLY if it doesn't hold a number.
+    # Only for replies from the processor, error strings are decoded by CinemaProcessor.decodereply.
+    def decode(self, reply):
+        value = reply.strip()
+        if self.echo:
+            value = value.split(self.separator)[-1]
+        if value.isdigit():
+            return ProcessorState.Reply(int(value), text=reply)
+        return ProcessorState.Reply(None, ProcessorState.ErrorCode.BAD_REPLY, reply)
+
+    # True if reply looks like the answer to command. Replies without the parameter name can only be matched by order.
+    def matches(self, command, reply):
+        if not self.echo:
+            return True
+        return reply.split(self.separator)[0] == command.split(self.separator)[0]
+
+# Dolby processors answer with the parameter name and value, e.g. "cp750.sys.fader ?" -> "cp750.sys.fader 70".
+# The JSD60 and JSD100 only send the value back, and count the fader in tenths of a step.
+CODECS = {
+    'CP650': Codec('CP650', {'fader': 'fader_level', 'mute': 'mute'}, separator='='),
+    'CP750': Codec('CP750', {'fader': 'cp750.sys.fader', 'mute': 'cp750.sys.mute', 'version': 'cp750.sysinfo.version'}),
+    'CP850': Codec('CP850', {'fader': 'sys.fader', 'mute': 'sys.mute', 'version': 'sysinfo.version'}),
+    'CP950': Codec('CP950', {'fader': 'sys.fader', 'mute': 'sys.mute', 'version': 'sysinfo.version'}),
+    'JSD60': Codec('JSD60', {'fader': 'jsd60.sys.fader', 'mute': 'jsd60.sys.mute'}, separator='\t', query=None,
+                   echo=False, faderStep=10, faderMax=1000),
+    'JSD100': Codec('JSD100', {'fader': 'jsd100.sys.fader', 'mute': 'jsd100.sys.mute'}, separator='\t', query=None,
+                    echo=False, faderStep=10, faderMax=1000),
+}
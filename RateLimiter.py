@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+# Keeps the command rate to a Cinema Processor under what it can take.
+#
+# Processors start rejecting requests (or answering them wrongly) when they get too many too
+# fast. Every command passes through a token bucket: the bucket holds up to burst tokens and
+# refills at rate tokens per second, and each command takes one. Writes and reads wait for a
+# token, background polls only go out if there is one to spare, so polling never holds up the
+# user's changes.
+
+import asyncio
+import logging
+import time
+
+LOGGER = logging.getLogger(__name__)
+
+class TokenBucket():
+    def __init__(self, rate, burst, metrics=None):
+        self.rate = rate                # Tokens added per second
+        self.burst = burst              # Most tokens the bucket holds
+        self.tokens = burst             # Can go below zero when more was taken than there was
+        self.updated = time.monotonic()
+        self.metrics = metrics          # Metrics.ProcessorMetrics that counts waits and rejections
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated)*self.rate)
+        self.updated = now
+
+    # Takes tokens if they are there right now. Returns False (and takes nothing) if not.
+    def tryacquire(self, tokens=1):
+        self.refill()
+        if self.tokens < tokens:
+            if self.metrics is not None:
+                self.metrics.rateLimitRejects += tokens
+            return False
+        self.tokens -= tokens
+        return True
+
+    # Takes tokens, waiting for the bucket to refill if needed
+    async def acquire(self, tokens=1):
+        self.refill()
+        if self.tokens < tokens:
+            wait = (tokens - self.tokens) / self.rate
+            LOGGER.debug(f'Rate limit: waiting {wait*1000:.1f}ms')
+            if self.metrics is not None:
+                self.metrics.rateLimitWaits += 1
+                self.metrics.rateLimitWaitSeconds += wait
+            await asyncio.sleep(wait)
+            self.refill()
+        self.tokens -= tokens
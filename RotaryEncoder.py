@@ -2,50 +2,244 @@
 
 #Modified from https://github.com/mivallion/Encoder
  
+import argparse
+import fractions
+import random
 import signal                   
-import RPi.GPIO as GPIO
+import threading
 import time
 
+# Only there on a Raspberry Pi. Without it the encoder can't be used, but TickCounter and the stress test can.
+try:
+    import RPi.GPIO as GPIO
+except ImportError:
+    GPIO = None
+
+# Counts encoder ticks between the GPIO callback thread, which adds them, and the main loop,
+# which drains them. Both go through a lock, so no tick is lost however fast the knob spins.
+# Draining converts ticks to volume steps with the sensitivity, keeping whatever fraction of
+# a step is left over (exactly, as a Fraction) for the next drain.
+class TickCounter():
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.ticks = 0                              # Ticks added since the last drain
+        self.remainder = fractions.Fraction(0)      # Part of a volume step left over from earlier drains
+
+    def add(self, ticks):
+        with self.lock:
+            self.ticks += ticks
+
+    # Takes all the ticks added so far and returns them as whole volume steps, rounded toward
+    # zero so turning back and forth by the same amount always gives the same steps.
+    def drain(self, sensitivity=1):
+        with self.lock:
+            ticks = self.ticks
+            self.ticks = 0
+        if not ticks and not self.remainder:
+            return 0
+        total = self.remainder + ticks*fractions.Fraction(str(sensitivity))
+        steps = int(total)
+        self.remainder = total - steps
+        return steps
+
+# Ticks for each transition, indexed by (previous state) | (new state << 2), where a state
+# has pin A in bit 0 and pin B in bit 1. Transitions where both pins changed (an edge was
+# missed) count as two ticks in the direction the state code implies.
+TRANSITIONS = (0, 1, -1, 2, -1, 0, -2, 1, 1, -2, 0, -1, 2, -1, 1, 0)
+
+# How many edges the encoder remembers for velocity()
+EDGE_LOG_SIZE = 64
+
+# Returns the multiplier for speed (ticks per second) from a curve of (speed, multiplier)
+# points sorted by speed, interpolating linearly between the points
+def accelerate(speed, curve):
+    lastSpeed, lastMultiplier = curve[0]
+    if speed <= lastSpeed:
+        return lastMultiplier
+    for pointSpeed, multiplier in curve[1:]:
+        if speed <= pointSpeed:
+            return lastMultiplier + (multiplier - lastMultiplier) * (speed - lastSpeed) / (pointSpeed - lastSpeed)
+        lastSpeed, lastMultiplier = pointSpeed, multiplier
+    return lastMultiplier
+
+# Reads the encoder pins with RPi.GPIO
+class RPiGPIOBackend():
+    def __init__(self):
+        if GPIO is None:
+            raise RuntimeError('RPi.GPIO is not available')
+        GPIO.setmode(GPIO.BCM)
+
+    def setup(self, pin):
+        GPIO.setup(pin, GPIO.IN, pull_up_down=GPIO.PUD_UP)
+
+    def input(self, pin):
+        return GPIO.input(pin)
+
+    # Calls callback(pin) from the GPIO thread on every rising and falling edge of pin
+    def watch(self, pin, callback):
+        GPIO.add_event_detect(pin, GPIO.BOTH, callback=callback)
+
+# Pretends to be the encoder pins, for testing and benchmarking without a Raspberry Pi.
+# The callbacks run in whichever thread changes the pins.
+class SimulatedBackend():
+    # Next state when turning forward (+1 tick per edge) and backward, see TRANSITIONS
+    FORWARD = (2, 0, 3, 1)
+    BACKWARD = (1, 3, 0, 2)
+
+    def __init__(self):
+        self.levels = {}
+        self.callbacks = {}
+        self.pins = ()
+
+    def setup(self, pin):
+        self.levels[pin] = 1        # Pulled up
+        self.pins += (pin,)
+
+    def input(self, pin):
+        return self.levels[pin]
+
+    def watch(self, pin, callback):
+        self.callbacks[pin] = callback
+
+    def set(self, pin, level):
+        if self.levels[pin] != level:
+            self.levels[pin] = level
+            if pin in self.callbacks:
+                self.callbacks[pin](pin)
+
+    # Turns the knob by ticks edges, one pin change per tick
+    def turn(self, ticks):
+        A, B = self.pins
+        sequence = self.FORWARD if ticks > 0 else self.BACKWARD
+        for _ in range(abs(ticks)):
+            state = self.levels[A] | self.levels[B] << 1
+            changed = state ^ sequence[state]
+            if changed & 1:
+                self.set(A, 1 - self.levels[A])
+            else:
+                self.set(B, 1 - self.levels[B])
+
 #Rotary encoder and cp750 controller initialization
 class RotaryEncoder():
-    def __init__(self, A, B):
+    def __init__(self, A, B, backend=None):
         #Set up Rotary Encoder GPIO
-        GPIO.setmode(GPIO.BCM)
-        GPIO.setup(A, GPIO.IN, pull_up_down=GPIO.PUD_UP)
-        GPIO.setup(B, GPIO.IN, pull_up_down=GPIO.PUD_UP)
+        self.backend = backend if backend is not None else RPiGPIOBackend()
+        self.backend.setup(A)
+        self.backend.setup(B)
         self.A = A
         self.B = B
-        self.pos = 0                    # How many ticks turned since last update)
-        self.state = 0                  # 4 flags checking the current and previous state of the rotary encoder
-        if GPIO.input(A):
+        self.counter = TickCounter()    # Ticks turned since the main loop last drained them
+        # Fixed size ring buffer of (time.monotonic(), ticks), one entry per edge that moved the knob
+        self.edges = [(0.0, 0)] * EDGE_LOG_SIZE
+        self.edgeIndex = 0              # Where the next edge goes in self.edges
+        self.edgeLock = threading.Lock()
+        self.state = 0                  # Current pin levels, A in bit 0 and B in bit 1
+        if self.backend.input(A):
             self.state |= 1
-        if GPIO.input(B):
+        if self.backend.input(B):
             self.state |= 2
-        GPIO.add_event_detect(A, GPIO.BOTH, callback=self.__update)
-        GPIO.add_event_detect(B, GPIO.BOTH, callback=self.__update)
-    
+        self.backend.watch(A, self.__update)
+        self.backend.watch(B, self.__update)
+
+    # Returns the volume steps turned since the last call, see TickCounter.drain.
+    # With an acceleration curve (see Config.ACCELERATION) fast turns give bigger steps.
+    def drain(self, sensitivity=1, acceleration=None, window=0.1):
+        if acceleration:
+            sensitivity = sensitivity * accelerate(abs(self.velocity(window)), acceleration)
+        return self.counter.drain(sensitivity)
+
+    # Returns the remembered edges, oldest first, as (time.monotonic(), ticks)
+    def recentedges(self):
+        with self.edgeLock:
+            edges = self.edges[self.edgeIndex:] + self.edges[:self.edgeIndex]
+        return [edge for edge in edges if edge[1]]
+
+    # Returns how fast the knob turned over the last window seconds, in ticks per second
+    # (negative when turning down). Only the last EDGE_LOG_SIZE edges are remembered.
+    def velocity(self, window=0.1):
+        since = time.monotonic() - window
+        return sum(ticks for timestamp, ticks in self.recentedges() if timestamp >= since) / window
+
     """
     update() calling every time when value on A or B pins changes.
     It updates the pos based on previous and current states
     of the rotary encoder.
     """
     def __update(self, channel): 
-        state = self.state & 3
-        if GPIO.input(self.A):
-            state |= 4
-        if GPIO.input(self.B):
-            state |= 8
+        # Both pins are read, so an edge missed on the other pin shows up as a transition where
+        # both changed, which TRANSITIONS counts as two ticks
+        state = self.state
+        new = (1 if self.backend.input(self.A) else 0) | (2 if self.backend.input(self.B) else 0)
+        self.state = new
+
+        ticks = TRANSITIONS[state | new << 2]
+        if ticks:
+            self.counter.add(ticks)
+            with self.edgeLock:
+                self.edges[self.edgeIndex] = (time.monotonic(), ticks)
+                self.edgeIndex = (self.edgeIndex + 1) % EDGE_LOG_SIZE
+
+# Stress test: several threads fire ticks at a TickCounter as fast as they can while the main
+# thread keeps draining it, then checks that every tick came out the other end. Then the same
+# for a whole RotaryEncoder on the simulated backend, spun from another thread through the
+# decoder, which also gives the decoding speed.
+def main():
+    parser = argparse.ArgumentParser(description='Checks that no encoder ticks are lost under load.')
+    parser.add_argument('--threads', type=int, default=4)
+    parser.add_argument('--ticks', type=int, default=200000, help='ticks per thread')
+    parser.add_argument('--sensitivity', default='0.3')
+    args = parser.parse_args()
+
+    sensitivity = fractions.Fraction(args.sensitivity)
+    counter = TickCounter()
+    sent = [0] * args.threads
+
+    def fire(index):
+        rng = random.Random(index)
+        for _ in range(args.ticks):
+            ticks = rng.choice((1, 1, 1, -1, 2, -2))
+            sent[index] += ticks
+            counter.add(ticks)
+
+    ok = drainwhile(counter, sensitivity, [threading.Thread(target=fire, args=(index,)) for index in range(args.threads)],
+                    sent, 'TickCounter')
+
+    backend = SimulatedBackend()
+    encoder = RotaryEncoder(17, 18, backend)
+    turned = [0]
+
+    def spin():
+        rng = random.Random(0)
+        while abs(turned[0]) < args.ticks * args.threads:
+            ticks = rng.randint(-40, 60)
+            backend.turn(ticks)
+            turned[0] += ticks
 
-        self.state = state >> 2
+    ok = drainwhile(encoder, sensitivity, [threading.Thread(target=spin)], turned, 'RotaryEncoder') and ok
+    print(f'last edges: {encoder.recentedges()[-3:]}')
+    return 0 if ok else 1
 
-        if state == 1 or state == 7 or state == 8 or state == 14:
-            self.pos += 1
-        elif state == 2 or state == 4 or state == 11 or state == 13:
-            self.pos -= 1
-        elif state == 3 or state == 12:
-            self.pos += 2
-        elif state == 6 or state == 9:
-            self.pos -= 2
+# Drains target until threads are finished, then checks the steps add up to the ticks in sent
+def drainwhile(target, sensitivity, threads, sent, name):
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    steps = 0
+    drains = 0
+    while any(thread.is_alive() for thread in threads):
+        steps += target.drain(sensitivity)
+        drains += 1
+    for thread in threads:
+        thread.join()
+    steps += target.drain(sensitivity)
+    elapsed = time.perf_counter() - start
 
+    counter = getattr(target, 'counter', target)
+    expected = sum(sent)*sensitivity
+    ok = steps + counter.remainder == expected
+    print(f'{name}: net ticks {sum(sent)} in {elapsed:.2f}s, {drains} drains, steps {steps}, '
+          f'remainder {counter.remainder}, expected {expected}: {"OK" if ok else "TICKS LOST"}')
+    return ok
 
-    
\ No newline at end of file
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -1,26 +1,19 @@
 #!/usr/bin/env python3
 
 import time
-import math
-import board
-import busio
-from adafruit_ht16k33 import segments
-import tm1637
-from PIL import Image, ImageDraw, ImageFont
-import adafruit_ssd1306
+import importlib
 import logging
 from datetime import datetime
-from pynput.keyboard import *
 from enum import Enum
 
 #Files should be in the same folder as this file.
-import CP650Control
-import CP750Control
-import CP850Control
-import JSD60Control
-import JSD100Control
+#The hardware libraries and the Cinema Processor drivers aren't imported here, see the registries below.
 import RotaryEncoder
 import ChangeIP
+import Metrics
+import AdaptivePoller
+import DisplayOutput
+import DisplayWorker
 import Config
 
 # Switch to debug if you want a lot of unnecessary garbage in your log file when things go weird.
@@ -48,6 +41,46 @@ class CPTypeCode(Enum):
 # UPDATE THIS WHEN YOU ADD MORE CPTypeCodes!    
 LASTCPTYPEVALUE = 6
 
+# The driver module for each CPTypeCode, the class in it has the same name. Only the driver
+# in use gets imported (see loadDriver), so adding a processor doesn't slow down booting.
+DRIVERS = {
+    CPTypeCode.CP650: 'CP650Control',
+    CPTypeCode.CP750: 'CP750Control',
+    CPTypeCode.CP850: 'CP850Control',
+    CPTypeCode.CP950: 'CP950Control',
+    CPTypeCode.JSD60: 'JSD60Control',
+    CPTypeCode.JSD100: 'JSD100Control',
+}
+DEFAULT_DRIVER = 'CP850Control'
+
+# The libraries behind the hardware. The 7 segment display's depend on DISPLAYTYPE, the OLED and
+# the keyboard are always there. They are imported when the hardware is set up, so a Pi only
+# loads what is fitted. See Benchmark.py --startup for how long that takes.
+SEGMENT_LIBRARIES = {
+    0: (),
+    1: ('board', 'busio', 'adafruit_ht16k33.segments'),
+    2: ('tm1637',),
+}
+OLED_LIBRARIES = ('board', 'busio', 'adafruit_ssd1306', 'OLEDRenderer')
+KEYBOARD_LIBRARIES = ('pynput.keyboard',)
+
+# Imports the named modules (once, later calls get them from sys.modules) and returns them in order
+def load(names):
+    return [importlib.import_module(name) for name in names]
+
+# Returns the class of the driver for cpTypeCode, importing its module
+def loadDriver(cpTypeCode):
+    name = DRIVERS.get(cpTypeCode)
+    if name is None:
+        logging.error('Invalid cinema processor type (CPTYPE), check config. defaulting to CP850/CP950')
+        name = DEFAULT_DRIVER
+    return getattr(importlib.import_module(name), name)
+
+# Every module main() loads for displayType and cpTypeCode, in the order it loads them
+def startupModules(displayType, cpTypeCode):
+    names = SEGMENT_LIBRARIES.get(displayType, ()) + OLED_LIBRARIES + KEYBOARD_LIBRARIES + (DRIVERS.get(cpTypeCode, DEFAULT_DRIVER),)
+    return tuple(dict.fromkeys(names))
+
 # Encoder pins
 APIN=Config.APIN
 BPIN=Config.BPIN
@@ -57,8 +90,11 @@ DISPLAYTYPE = Config.DISPLAYTYPE
 # Encoder Sensitivity
 SENSITIVITY = Config.SENSITIVITY
 
-# Polling rate
-delay=Config.POLLING_DELAY
+# Decides when to next ask the Cinema Processor for the fader level
+poller = AdaptivePoller.AdaptivePoller()
+
+# How often the main loop checks the encoder and the outstanding processor requests
+loopDelay=Config.LOOP_DELAY
 
 # Absolute filepath to the project folder. 
 FILEPATH=Config.FILEPATH
@@ -66,6 +102,14 @@ FILEPATH=Config.FILEPATH
 # Cinema Processor
 cp = None
 
+# Future for the background connect, None once connected
+connectRequest = None
+
+# Requests to the Cinema Processor run on its event loop. The main loop only starts them
+# and picks up the results once they are done, so it never waits on the network.
+# This is the display poll in flight, None if there isn't one.
+pollRequest = None
+
 # flag is set to tell the loop to terminate the program.
 terminate = False
 
@@ -78,6 +122,22 @@ errorOutput = ""
 # Used when no separate 7-segment display is enabled
 displayFader = "    "
 
+# pynput's Key, set by setUpKeyboard when pynput is loaded
+Key = None
+
+# Draws on the displays in the background, so neither the main loop nor the keyboard listener
+# waits on the I2C bus. Only the latest frame posted for each display gets drawn.
+def drawSegments(data):
+    segmentOutput.show(data)
+
+# Draws a (layout, texts) frame made by refeshOLED().
+# Nothing is sent if the frame is the same as last time, otherwise only the pages that changed are sent.
+def drawOLED(frame):
+    if renderer.render(*frame):
+        oledOutput.show(renderer.image)
+
+displayWorker = DisplayWorker.DisplayWorker({'segments': drawSegments, 'oled': drawOLED})
+
 # this function is called when a keyboard key is pressed
 def press_on(key):
     global cp,terminate,keyInput,pState,cpType,host,ownIP,newCPType
@@ -87,9 +147,15 @@ def press_on(key):
         refeshOLED()
         return False
     elif key == Key.media_volume_up:
-        cp.addfader(1)
+        cp.submit(cp.aaddfader(1))     # Don't wait for the processor, the listener thread has to stay responsive
+        poller.activity()
     elif key == Key.media_volume_down:
-        cp.addfader(-1)
+        cp.submit(cp.aaddfader(-1))
+        poller.activity()
+    elif pState == ProgramState.CONNECTED and keyname(key) in Config.FADE_PRESETS:
+        level, seconds, curve = Config.FADE_PRESETS[keyname(key)]
+        cp.fade(round(level*10)*cp.FADER_STEP, seconds, curve)
+        poller.activity()
     elif key == Key.f1 and pState in (ProgramState.CONNECTING, ProgramState.CONNECTED, ProgramState.ERROR):
         pState = ProgramState.EDIT_CPTYPE
         newCPType = cpType
@@ -136,13 +202,20 @@ def press_on(key):
             refeshOLED()
 
             
+# Returns the name used for key in Config.FADE_PRESETS: 'f5' for Key.f5, the character for character keys
+def keyname(key):
+    return getattr(key, 'name', None) or getattr(key, 'char', None)
+
 # This function is called when a key is released.   
 def press_off(key):
     pass
     
 # Set up the keyboard listener to run press_on when a key is pressed.
 def setUpKeyboard():
-    Listener(on_press = press_on, on_release = press_off).start()
+    global Key
+    keyboard, = load(KEYBOARD_LIBRARIES)
+    Key = keyboard.Key
+    keyboard.Listener(on_press = press_on, on_release = press_off).start()
 
 # Extract saved data from data.txt
 def getData():
@@ -182,9 +255,10 @@ def saveData():
 
 # Sets up the 7 segment display.
 def setUp7Seg():
-    global adafruit_7seg,tm1637_7seg
+    global adafruit_7seg,tm1637_7seg,segmentOutput
     
     if(DISPLAYTYPE == 1):
+        board, busio, segments = load(SEGMENT_LIBRARIES[1])
         # Create the I2C interface.
         i2c = busio.I2C(board.SCL, board.SDA)
 
@@ -194,26 +268,32 @@ def setUp7Seg():
 
         # Clear the display.
         adafruit_7seg.fill(0)
+
+        # Only write to the display when told to, so unchanged digits can be skipped.
+        adafruit_7seg.auto_write = False
+        segmentOutput = DisplayOutput.HT16K33Output(adafruit_7seg)
     elif(DISPLAYTYPE == 2):
+        tm1637, = load(SEGMENT_LIBRARIES[2])
         tm1637_7seg = tm1637.TM1637(clk=Config.CLK, dio=Config.DIO)
         tm1637_7seg.brightness(0) 
+        segmentOutput = DisplayOutput.TM1637Output(tm1637_7seg)
     # if DISPLAYTYPE == 0: pass 
 
+# Identical frames are skipped and only changed digits are written (see DisplayOutput).
+# Returns straight away, the display worker does the writing.
 def print7seg(data):
-    global adafruit_7seg,tm1637_7seg,displayFader
+    global displayFader
     
     if(DISPLAYTYPE == 0):
         displayFader = data
         refeshOLED()
-    elif(DISPLAYTYPE == 1):
-        adafruit_7seg.print(data)
-    elif(DISPLAYTYPE == 2):
-        data = data.replace(".","")
-        tm1637_7seg.show(data)
+    elif(DISPLAYTYPE in (1, 2)):
+        displayWorker.post('segments', data)
 
 # Sets up the OLED display.
 def setUpOLED():
-    global displayOLED
+    global displayOLED, renderer, oledOutput
+    board, busio, adafruit_ssd1306, OLEDRenderer = load(OLED_LIBRARIES)
     # Create the I2C interface.
     i2c = busio.I2C(board.SCL, board.SDA)
 
@@ -222,45 +302,26 @@ def setUpOLED():
     # to the right size for your display!
     displayOLED = adafruit_ssd1306.SSD1306_I2C(128, 32, i2c)
 
+    # Fonts are loaded and the frame buffer allocated once, here.
+    renderer = OLEDRenderer.OLEDRenderer(displayOLED.width, displayOLED.height, f'{FILEPATH}/fonts/hack/Hack-Regular.ttf',
+                                         atlasPath=Config.GLYPH_ATLAS)
+
     # Clear display.
     displayOLED.fill(0)
     displayOLED.show()
+    oledOutput = DisplayOutput.OLEDOutput(displayOLED)
     refeshOLED()
 
 # Update the OLED display with what the current state of the program is.
 # After you change the program state or any of the displayed variables on the OLEd
 # you'll need to call this to update the OLED to show the changes.
+# The text is put together here and handed to the display worker, which draws it.
 def refeshOLED():
-    global displayOLED, pState, errorOutput, newCPType, displayFader
-    # Create blank image for drawing.
-    # Make sure to create image with mode '1' for 1-bit color.
-    width = displayOLED.width
-    height = displayOLED.height
-    image = Image.new("1", (width, height)) # 1-bit color image to write on.
-
-    # Get drawing object to draw on image.
-    draw = ImageDraw.Draw(image)
-
-    # Draw a black filled box to clear the image.
-    draw.rectangle((0, 0, width, height), outline=0, fill=0)
-
-    # Draw some shapes.
-    # First define some constants to allow easy resizing of shapes.
-    padding = -2
-    top = padding
-    bottom = height - padding
-    # Move left to right keeping track of the current x position for drawing shapes.
-    x = 0
-
-    # Load default font.
-    font = ImageFont.load_default()
-    
+    global pState, errorOutput, newCPType, displayFader
     if (pState == ProgramState.CONNECTED and DISPLAYTYPE == 0):
         # When the fader is connected and DISPLAYTYPE is 0, print the volume on the OLED
-        font = ImageFont.truetype(f'{FILEPATH}/fonts/hack/Hack-Regular.ttf', 34)
-        draw.text((x, top + 0), f"{displayFader}", font=font, fill=255)
+        frame = ('fader', (f"{displayFader}",))
     else:
-        font = ImageFont.load_default()
         # Construct the input/message line at the bottom of the OLED display based on program state
         inputLine = ""
         if pState == ProgramState.LOADING:
@@ -287,14 +348,10 @@ def refeshOLED():
         else:
             inputLine = "PROGRAM STATE UNKNOWN"
             
-        # Construct the display text.
-        draw.text((x, top + 0), f"CP TYPE: {cpType.name}", font=font, fill=255)
-        draw.text((x, top + 8), f"CPIP: {host}", font=font, fill=255)
-        draw.text((x, top + 16),f"OWNIP:{ownIP}", font=font, fill=255)
-        draw.text((x, top + 25),inputLine , font=font, fill=255)
+        # Construct the display text. Only the lines that changed get redrawn.
+        frame = ('status', (f"CP TYPE: {cpType.name}", f"CPIP: {host}", f"OWNIP:{ownIP}", inputLine))
     
-    displayOLED.image(image)
-    displayOLED.show()
+    displayWorker.post('oled', frame)
 
 def constructCinemaProcessorObject():
     global cp
@@ -302,50 +359,84 @@ def constructCinemaProcessorObject():
         if(cp.getState() == "connected"):
             cp.disconnect()
         cp = None
-    if(cpType == CPTypeCode.CP650):
-        cp = CP650Control.CP650Control(host)
-    elif(cpType == CPTypeCode.CP750):
-        cp = CP750Control.CP750Control(host)
-    elif(cpType in [CPTypeCode.CP850, CPTypeCode.CP950]):
-        cp = CP850Control.CP850Control(host)
-    elif(cpType == CPTypeCode.JSD60):
-        cp = JSD60Control.JSD60Control(host)
-    elif(cpType == CPTypeCode.JSD100):
-        cp = JSD100Control.JSD100Control(host)
-    else:
-        logging.error('Invalid cinema processor type (CPTYPE), check config. defaulting to CP850/CP950')
-        cp = CP850Control.CP850Control(host)
+    # Use the processor's usual port unless Config says otherwise
+    address = (host,) if Config.CPPORT is None else (host, Config.CPPORT)
+    cp = loadDriver(cpType)(*address)
+    cp.stateCache.subscribe(showState)
+
+# Called on the Cinema Processor's event loop whenever its state changes (see CinemaProcessor.StateCache),
+# so the display follows the fader without the main loop asking.
+def showState(state):
+    if(state.ok):
+        currentFader = cp.formatfader(state.fader)
+        print(currentFader+'                       ',end='\r') #Prints to the console
+        print7seg(currentFader) #Prints the volume to the 7 segment display
     
 
-def setUpCinemaProcessor():
-    global cp, pState, display7seg
-    constructCinemaProcessorObject()
-    pState = ProgramState.CONNECTING
-    refeshOLED()
-    
-    cp.connect()
+# Starts connecting to the Cinema Processor in the background (see CinemaProcessor.reconnect),
+# making a new Cinema Processor object first unless reconstruct is False. The main loop picks
+# up connectRequest once it is done, the display and keyboard keep working in the meantime.
+def setUpCinemaProcessor(reconstruct=True):
+    global cp, pState, connectRequest
+    if connectRequest is not None:
+        connectRequest.cancel()
+    if reconstruct:
+        constructCinemaProcessorObject()
+    # Don't throw the user out of the settings they are editing
+    if pState not in (ProgramState.EDIT_CPTYPE, ProgramState.EDIT_CPIP, ProgramState.EDIT_OWNIP):
+        pState = ProgramState.CONNECTING
+        refeshOLED()
+    print('Check connection                               ',end='\r')
+    connectRequest = cp.reconnect()
     
-    #Check to see if the Cinema Processor is connected and if it isn't, keep trying each 1 second
-    while cp.getState() != 'connected':
+# One pass of the main loop, with the encoder enc. Benchmark.py runs it too, to measure the real thing.
+def loopStep(enc):
+    global pState, connectRequest, pollRequest
+    if (pState == ProgramState.RESTART):
+        ChangeIP.changeStaticIP(ownIP)
+        setUpCinemaProcessor()
+        pollRequest = None
         
-        #Checks to see if the program has been manually terminated
-        if terminate:
+    # Connecting goes on in the background. Until it's done, knob turns have nowhere to go.
+    if(connectRequest is not None):
+        if(not connectRequest.done()):
+            enc.drain(SENSITIVITY)
             return
-        
-        print('Check connection                               ',end='\r')
-        time.sleep(1) #Consider making this configurable?
-        if(pState == ProgramState.RESTART):
-            ChangeIP.changeStaticIP(ownIP)
-            constructCinemaProcessorObject()
-            pState = ProgramState.CONNECTING
+        connectRequest = None
+        if(pState == ProgramState.CONNECTING):
+            pState = ProgramState.CONNECTED
             refeshOLED()
-        cp.connect()
-    pState = ProgramState.CONNECTED
-    refeshOLED()
-    return
-    
+        poller.activity()
+        
+    # If the encoder was turned, add/subtract it from the fader (modified by sensitivity).
+    # Draining takes the ticks from the GPIO callbacks atomically and keeps any part of a step
+    # left over by the sensitivity for next time, so neither ticks nor half-ticks get dropped.
+    # Fast spins are accelerated into bigger steps (Config.ACCELERATION).
+    # Changes are coalesced by the fader scheduler, which swallows them during connection difficulty.
+    volumeChange = enc.drain(SENSITIVITY, Config.ACCELERATION, Config.ACCELERATION_WINDOW)
+    if(volumeChange):
+        cp.submit(cp.aaddfader(volumeChange))
+        poller.activity()
+            
+    #Poll the Cinema Processor for changes made elsewhere. The display itself is updated by
+    #showState whenever the state changes, including straight after we moved the fader ourselves.
+    #The poller asks often right after the knob or keyboard was used and backs off while idle.
+    if(pollRequest is None and poller.due()):
+        pollRequest = cp.submit(cp.apoll())
+    elif(pollRequest is not None and pollRequest.done()):
+        state = pollRequest.result()
+        pollRequest = None
+        if(state is None):
+            poller.skipped()    #Held back by the rate limiter, the processor is fine
+        else:
+            poller.polled(state.ok, cp.rtt.srtt)
+        if(state is not None and not state.ok and poller.failures >= Config.POLLING_MAX_FAILURES):
+            print('Connection Issue                       ',end='\r')
+            print7seg('E   ') 
+            setUpCinemaProcessor(reconstruct=False)     #Reconnect the socket in the background.
+
 def main():
-    global cp, pState
+    global cp, pState, connectRequest
     pState = ProgramState.LOADING
     
     # Set up logging
@@ -354,6 +445,8 @@ def main():
     
     # Load settings from data.txt
     getData()
+    Metrics.startExporter()
+    displayWorker.start()
     # Initialize displays, cp,and encoder
     setUp7Seg()
     setUpOLED()
@@ -373,35 +466,15 @@ def main():
 
     
     while not terminate:
-        if (pState == ProgramState.RESTART):
-            ChangeIP.changeStaticIP(ownIP)
-            setUpCinemaProcessor()
-            
-        # If the position of the encoder changed, add/subtract it from the fader (modified by sensitivity)
-        # Then adjust the position tracking value accordingly (used to be set back to zero, but
-        # the sensitivity value would risk dropping half-ticks and the like.
-        volumeChange = math.floor(enc.pos*SENSITIVITY)
-        if(volumeChange):
-            if(cp.addfader(volumeChange)):          #Send the volume change and check to see if it went through correctly
-                enc.pos = enc.pos - (volumeChange/SENSITIVITY)
-            else:
-                enc.pos = 0                         #Swallow any volume changes during connection difficulty
-                
-        #Update the display with the current value
-        currentFader = cp.displayfader()
-        if(currentFader):
-            print(currentFader+'                       ',end='\r') #Prints to the console
-            print7seg(currentFader) #Prints the volume to the 7 segment display
-            
-        else:
-            print('Connection Issue                       ',end='\r')
-            print7seg('E   ') 
-            setUpCinemaProcessor()              #Disconnect and reconnect socket.
-        time.sleep(delay)
+        loopStep(enc)
+        time.sleep(loopDelay)
         
     # When the program is terminated, disconnect from the Cinema Processor and clear the displays.
+    if connectRequest is not None:
+        connectRequest.cancel()
     cp.disconnect()
     print7seg("    ")
+    displayWorker.flush()       # Let the worker finish before clearing the OLED behind its back
     displayOLED.fill(0)
     displayOLED.show()
     